@@ -0,0 +1,159 @@
+"""Stand-ins for the microphone, the wake word engines, the speech-to-text service and the inference providers, so that
+the pipeline can be driven offline, without devices or access keys."""
+import asyncio
+import random
+import threading
+import time
+import wave
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from inference_clients import AsyncInferenceClientBase, EncodedImage
+from listener import WakeWordDetector
+from speech_backends import SpeechBackend
+
+
+def synthetic_pcm(seconds=10.0, sample_rate=16000, seed=0):
+    """Room noise with bursts of voice-like tones, in case there is no recording to replay"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    noise = rng.normal(0, 200, t.size)
+    # 300ms bursts every 500ms
+    bursts = ((t % 0.5) < 0.3) * 3000 * np.sin(2 * np.pi * 220 * t)
+    return np.clip(noise + bursts, -32768, 32767).astype(np.int16)
+
+
+def read_wav(path):
+    with wave.open(path, "rb") as f:
+        if f.getframerate() != 16000 or f.getnchannels() != 1 or f.getsampwidth() != 2:
+            raise ValueError(f"{path} has to be 16kHz mono 16-bit PCM")
+        return np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16)
+
+
+class ReplayRecorder:
+    """PvRecorder look-alike that replays PCM in a loop, paced in real time"""
+
+    def __init__(self, pcm, frame_length=512, sample_rate=16000):
+        self._pcm = pcm
+        self._frame_length = frame_length
+        self._frame_duration = frame_length / sample_rate
+        self._position = 0
+        self._next_frame_at = 0.0
+        self._recording = threading.Event()
+        self._finished = False
+
+    @property
+    def is_recording(self):
+        return self._recording.is_set()
+
+    def start(self):
+        if self._finished:
+            return
+        self._next_frame_at = time.monotonic()
+        self._recording.set()
+
+    def stop(self):
+        self._recording.clear()
+
+    def finish(self):
+        """Stops for good; later calls to start() are ignored"""
+        self._finished = True
+        self.stop()
+
+    def delete(self):
+        self.finish()
+
+    def read(self):
+        if not self._recording.is_set():
+            raise RuntimeError("Recorder is not recording")
+        # A frame is only available once it has been "spoken"
+        self._next_frame_at += self._frame_duration
+        delay = self._next_frame_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        indices = (self._position + np.arange(self._frame_length)) % len(self._pcm)
+        self._position += self._frame_length
+        return self._pcm[indices]
+
+
+class ScriptedDetector(WakeWordDetector):
+    """Fires `wake_after` seconds of audio after every reset"""
+
+    def __init__(self, timeline, wake_after=1.0, sample_rate=16000):
+        super().__init__("scripted")
+        self._timeline = timeline
+        self._wake_after_samples = int(wake_after * sample_rate)
+        self._samples = 0
+
+    def reset(self):
+        self._samples = 0
+
+    def process(self, pcm):
+        self._samples += len(pcm)
+        if self._samples < self._wake_after_samples:
+            return None
+        self._timeline.start_cycle()
+        return "scripted"
+
+
+class ScriptedSpeechBackend(SpeechBackend):
+    """Yields the transcripts of `script` once the audio they were "said" in has been streamed, each after
+    `response_latency` seconds, like a streaming service would"""
+    name = "scripted"
+
+    def __init__(self, script=((0.6, "a cat"), (1.2, "a cat barbequing"), (1.8, "a cat barbequing with headphones on")),
+                 response_latency=0.15, endpoint_delay=0.5, sample_rate=16000):
+        """
+        script: (seconds of audio, transcript) pairs; the last one is the final transcript
+        endpoint_delay: Seconds of audio after the last transcript until the end of the utterance is detected
+        """
+        self._script = script
+        self._response_latency = response_latency
+        self._endpoint_delay = endpoint_delay
+        self._sample_rate = sample_rate
+
+    def transcribe(self, audio_generator):
+        audio_seconds = 0.0
+        script = list(self._script)
+        end_at = script[-1][0] + self._endpoint_delay
+
+        for content in audio_generator:
+            audio_seconds += len(content) / (2 * self._sample_rate)
+            while script and audio_seconds >= script[0][0]:
+                _, transcript = script.pop(0)
+                time.sleep(self._response_latency)
+                yield transcript
+            if audio_seconds >= end_at:
+                return
+
+
+class FakeInferenceClient(AsyncInferenceClientBase):
+    """Provider with log-normally distributed latency and a failure rate.
+    `median_latency` is that of a 1024x1024 image in 4 steps; smaller and fewer-step images are proportionally faster,
+    apart from a fixed 30% of overhead."""
+
+    def __init__(self, name, median_latency=2.0, sigma=0.4, failure_rate=0.0, cost_per_image=0.0, seed=None):
+        super().__init__(api_key="fake")
+        self._name = name
+        self._median_latency = median_latency
+        self._sigma = sigma
+        self._failure_rate = failure_rate
+        self.cost_per_image = cost_per_image
+        self._random = random.Random(seed)
+
+    async def text_to_image(self, text, height=1024, width=1024, steps=4):
+        work = 0.3 + 0.7 * (steps / 4) * (height * width / 1024 ** 2)
+        await asyncio.sleep(self._median_latency * work * self._random.lognormvariate(0, self._sigma))
+        if self._random.random() < self._failure_rate:
+            raise RuntimeError(f"{self._name} failed (simulated)")
+        color = tuple(self._random.randrange(256) for _ in range(3))
+        # Encoded, like the providers send it
+        data = BytesIO()
+        Image.new("RGB", (width, height), color).save(data, format="JPEG")
+        return EncodedImage(data.getvalue())
+
+    def __str__(self):
+        return self._name
@@ -0,0 +1,106 @@
+"""Checks that a DreamServer gets every dream to a fleet of DreamFrames, and how long that takes.
+
+Starts a server with a fake inference provider in a temporary directory, connects `--frames` frames to it, requests
+`--dreams` dreams and waits until every frame has shown every one of them. Needs no network, display or access keys.
+
+    python benchmarks/fleet_check.py --frames 10 --dreams 5
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import Request, urlopen
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.fakes import FakeInferenceClient  # noqa: E402
+from dream_frame import DreamFrame  # noqa: E402
+from dream_server import DreamServer  # noqa: E402
+from dreamer import Dreamer  # noqa: E402
+
+
+class RecordingDisplayer:
+    """Remembers what it was asked to show, and when"""
+
+    def __init__(self):
+        self.shown = list()
+        self._cond = threading.Condition()
+
+    def show_image(self, path):
+        with self._cond:
+            self.shown.append((time.time(), os.path.basename(path)))
+            self._cond.notify_all()
+
+    def wait_for(self, name, timeout):
+        with self._cond:
+            return self._cond.wait_for(lambda: any(shown == name for _, shown in self.shown), timeout=timeout)
+
+    def run(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=10)
+    parser.add_argument("--dreams", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.5, help="Median seconds per fake image")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for a dream to reach all frames")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        dreams_dir = os.path.join(work_dir, "dreams")
+        dreamer = Dreamer(clients=[FakeInferenceClient("fake", median_latency=args.latency, seed=0)],
+                          dreams_dir=dreams_dir)
+        server = DreamServer(dreamer, port=0, image_size=(512, 512), dreams_dir=dreams_dir, token="fleet")
+        server.start(periodic=False)
+        server_url = f"http://127.0.0.1:{server.port}/"
+
+        frames = list()
+        for i in range(args.frames):
+            displayer = RecordingDisplayer()
+            frame = DreamFrame(server_url, displayer, cache_dir=os.path.join(work_dir, f"frame{i}"), retry_interval=0.5)
+            frame.start()
+            frames.append((frame, displayer))
+        # Every frame subscribes before the first dream
+        time.sleep(1)
+
+        latencies, failed = list(), 0
+        for i in range(args.dreams):
+            request = Request(f"{server_url}dreams", data=f'{{"prompt": "fleet dream {i}"}}'.encode(),
+                              headers={"Content-Type": "application/json", "Authorization": "Bearer fleet"},
+                              method="POST")
+            with urlopen(request, timeout=60) as response:
+                dream = json.load(response)
+            name = os.path.basename(dream["image"])
+            reached = 0
+            for _, displayer in frames:
+                if not displayer.wait_for(name, args.timeout):
+                    continue
+                reached += 1
+                shown_at = next(ts for ts, shown in displayer.shown if shown == name)
+                latencies.append(shown_at - dream["ts"])
+            failed += len(frames) - reached
+            print(f"Dream {i + 1}/{args.dreams} reached {reached}/{len(frames)} frames")
+
+        for frame, _ in frames:
+            frame.stop()
+        server.stop()
+        dreamer.shutdown()
+
+    print(f"Dreams generated: {server.generated} (expected {args.dreams})")
+    if latencies:
+        latencies.sort()
+        print(f"Publish to shown: median {statistics.median(latencies) * 1000:.1f}ms, "
+              f"max {latencies[-1] * 1000:.1f}ms over {len(latencies)} deliveries")
+    if failed or server.generated != args.dreams:
+        print(f"FAILED: {failed} deliveries missing")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""End-to-end latency of an on-demand dream, from wake word to image on screen.
+
+Drives Dreamscaper.on_demand_dream with recorded (or synthetic) PCM replayed into the Listener, a scripted speech-to-text
+engine, fake inference providers with configurable latency and failure rate, and pygame on the dummy SDL video driver.
+Needs the Python dependencies in requirements.txt, but no network, microphone, display or access keys.
+
+    python benchmarks/pipeline_benchmark.py --cycles 20 --budget image_blitted=6
+
+Stages are timed from the wake word:
+    listening_ui        first frame of the listening animation pushed to the display
+    first_transcript    first interim transcript pushed to the display
+    final_transcript    end of listening
+    draft_blitted       low-resolution draft pushed to the display (progressive mode only)
+    image_received      final image generated
+    image_blitted       image pushed to the display
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import pygame  # noqa: E402
+
+from benchmarks.fakes import (FakeInferenceClient, ReplayRecorder, ScriptedDetector, ScriptedSpeechBackend,  # noqa: E402
+                              read_wav, synthetic_pcm)
+from displayer import Displayer  # noqa: E402
+from dreamer import Dreamer  # noqa: E402
+from listener import AudioBus, Listener  # noqa: E402
+from main import Dreamscaper  # noqa: E402
+
+STAGES = ("listening_ui", "first_transcript", "final_transcript", "draft_blitted", "image_received", "image_blitted")
+
+
+class Timeline:
+    """Timestamps of the stages of every wake cycle"""
+
+    def __init__(self):
+        self.cycles = list()
+        self._lock = threading.Lock()
+        self.completed = threading.Condition(self._lock)
+
+    def start_cycle(self):
+        with self._lock:
+            self.cycles.append({"wake": time.monotonic()})
+
+    def mark(self, stage):
+        """Records the first time `stage` is reached in the current cycle"""
+        with self._lock:
+            if self.cycles and stage not in self.cycles[-1]:
+                self.cycles[-1][stage] = time.monotonic()
+                if stage == STAGES[-1]:
+                    self.completed.notify_all()
+
+    def num_completed(self):
+        return sum(STAGES[-1] in cycle for cycle in self.cycles)
+
+    def latencies(self):
+        """Seconds from the wake word to every stage, per stage"""
+        with self._lock:
+            return {stage: [cycle[stage] - cycle["wake"] for cycle in self.cycles if stage in cycle]
+                    for stage in STAGES}
+
+
+class TimedDisplayer(Displayer):
+    def __init__(self, timeline, **kwargs):
+        super().__init__(**kwargs)
+        self._timeline = timeline
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+        self.dream_images = set()
+        self.draft_images = set()
+
+    def _expect_on_screen(self, stage):
+        with self._pending_lock:
+            self._pending.add(stage)
+
+    def show_listening(self):
+        self._expect_on_screen("listening_ui")
+        super().show_listening()
+
+    def show_dream_prompt(self, dream_text):
+        super().show_dream_prompt(dream_text)
+        # The render loop draws it
+        self._expect_on_screen("first_transcript")
+
+    def show_image(self, image_path="assets/logo.jpeg", size=None, center=None):
+        super().show_image(image_path, size=size, center=center)
+        if image_path in self.dream_images:
+            self._expect_on_screen("image_blitted")
+        elif image_path in self.draft_images:
+            self._expect_on_screen("draft_blitted")
+
+    def _update_display(self):
+        super()._update_display()
+        with self._pending_lock:
+            pending, self._pending = self._pending, set()
+        for stage in pending:
+            self._timeline.mark(stage)
+
+
+class TimedListener(Listener):
+    def __init__(self, timeline, **kwargs):
+        super().__init__(**kwargs)
+        self._timeline = timeline
+
+    def listen_for_dream(self):
+        # Every prompt is new, so that the cache doesn't hide the providers' latency
+        cycle = len(self._timeline.cycles)
+        for dream_text in super().listen_for_dream():
+            yield f"{dream_text}#{cycle}"
+        self._timeline.mark("final_transcript")
+
+
+class TimedDreamer(Dreamer):
+    def __init__(self, timeline, displayer, **kwargs):
+        super().__init__(**kwargs)
+        self._timeline = timeline
+        self._displayer = displayer
+
+    def _store(self, text, image, client, latency, save_as, cache_key, *args, **kwargs):
+        dream_img = super()._store(text, image, client, latency, save_as, cache_key, *args, **kwargs)
+        # Drafts of progressive dreams are not cached, final images are
+        if cache_key:
+            self._timeline.mark("image_received")
+            self._displayer.dream_images.add(dream_img)
+        else:
+            self._displayer.draft_images.add(dream_img)
+        return dream_img
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    k = (len(values) - 1) * q / 100
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(latencies):
+    return {stage: {"n": len(values),
+                    "p50": percentile(values, 50),
+                    "p95": percentile(values, 95),
+                    "p99": percentile(values, 99)}
+            for stage, values in latencies.items()}
+
+
+def parse_providers(specs):
+    """name:median_latency:failure_rate[:cost_per_image]"""
+    clients = list()
+    for i, spec in enumerate(specs):
+        name, median_latency, failure_rate, *cost = spec.split(":")
+        clients.append(FakeInferenceClient(name,
+                                           median_latency=float(median_latency),
+                                           failure_rate=float(failure_rate),
+                                           cost_per_image=float(cost[0]) if cost else 0.0,
+                                           seed=i))
+    return clients
+
+
+def run(args):
+    os.chdir(REPO_DIR)  # The displayer's assets are relative to it
+    pcm = read_wav(args.wav) if args.wav else synthetic_pcm()
+    timeline = Timeline()
+
+    displayer = TimedDisplayer(timeline)
+    recorder = ReplayRecorder(pcm)
+    listener = TimedListener(timeline,
+                             audio_bus=AudioBus([ScriptedDetector(timeline, wake_after=args.wake_after)],
+                                                recorder=recorder),
+                             speech_backend=ScriptedSpeechBackend(response_latency=args.stt_latency,
+                                                                  endpoint_delay=args.endpoint_delay))
+
+    with tempfile.TemporaryDirectory() as dreams_dir:
+        dreamer = TimedDreamer(timeline, displayer,
+                               clients=parse_providers(args.provider),
+                               dreams_dir=dreams_dir,
+                               timeout=args.timeout,
+                               hedge_delay=args.hedge_delay,
+                               max_request_cost=args.max_request_cost)
+        dreamscaper = Dreamscaper(dreamer=dreamer, listener=listener, displayer=displayer,
+                                  progressive_on_demand=not args.no_progressive,
+                                  speculate=not args.no_speculation)
+
+        def stop_when_done():
+            with timeline.completed:
+                timeline.completed.wait_for(lambda: timeline.num_completed() >= args.cycles, timeout=args.max_duration)
+            recorder.finish()
+            pygame.event.post(pygame.event.Event(pygame.QUIT))
+
+        threading.Thread(target=dreamscaper.on_demand_dream, daemon=True).start()
+        threading.Thread(target=stop_when_done, daemon=True).start()
+        displayer.run()
+        dreamer.shutdown()
+
+    return summarize(timeline.latencies())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cycles", type=int, default=10, help="Number of on-demand dreams")
+    parser.add_argument("--wav", help="16kHz mono 16-bit recording to replay; synthetic audio by default")
+    parser.add_argument("--wake-after", type=float, default=1.0, help="Seconds of audio until the wake word fires")
+    parser.add_argument("--stt-latency", type=float, default=0.15, help="Seconds per speech-to-text response")
+    parser.add_argument("--endpoint-delay", type=float, default=0.5,
+                        help="Seconds of audio after the last word until the end of the utterance is detected")
+    parser.add_argument("--provider", action="append",
+                        help="Fake provider as name:median_latency:failure_rate[:cost_per_image]; repeatable. "
+                             "Default: fast:2:0.1 slow:5:0.3:0.001")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--hedge-delay", type=float, default=None)
+    parser.add_argument("--max-request-cost", type=float, default=0.0)
+    parser.add_argument("--no-speculation", action="store_true",
+                        help="Don't start generating before the end of the utterance has been detected")
+    parser.add_argument("--no-progressive", action="store_true", help="Don't show a draft before the final image")
+    parser.add_argument("--max-duration", type=float, default=600, help="Seconds after which the run is cut short")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--budget", action="append", default=list(),
+                        help="stage=seconds; exit with an error if the stage's p95 is over it. Repeatable.")
+    args = parser.parse_args()
+    args.provider = args.provider or ["fast:2:0.1", "slow:5:0.3:0.001"]
+
+    results = run(args)
+
+    print(f"{'stage':<20}{'n':>5}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for stage, result in results.items():
+        print(f"{stage:<20}{result['n']:>5}{result['p50']:>9.3f}{result['p95']:>9.3f}{result['p99']:>9.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    over_budget = list()
+    for budget in args.budget:
+        stage, seconds = budget.split("=")
+        if not results[stage]["p95"] <= float(seconds):
+            over_budget.append(f"{stage} p95 {results[stage]['p95']:.3f}s > {seconds}s")
+    if over_budget:
+        sys.exit("Over budget: " + "; ".join(over_budget))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""CPU time openWakeWord takes per hour of audio, with and without the EnergyGate, in a quiet and in a busy room.
+
+Runs the real openWakeWord models (downloaded to the package on first use, like the Listener does) over recorded or
+synthetic audio as fast as possible and measures the process CPU time. Run it on the device itself; the figures only
+hold for the CPU they were measured on.
+
+    python benchmarks/wake_cpu.py --seconds 120
+    python benchmarks/wake_cpu.py --idle-wav quiet_room.wav --active-wav living_room.wav
+"""
+import argparse
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from benchmarks.fakes import read_wav, synthetic_pcm  # noqa: E402
+from listener import EnergyGate, Listener, OpenWakeWordDetector  # noqa: E402
+
+
+def quiet_room_pcm(seconds, sample_rate=16000, seed=0):
+    """Nothing but the hiss of the microphone"""
+    rng = np.random.default_rng(seed)
+    return np.clip(rng.normal(0, 30, int(seconds * sample_rate)), -32768, 32767).astype(np.int16)
+
+
+def measure(model, pcm, gated, sample_rate=16000):
+    """Returns (CPU seconds per hour of audio, fraction of frames the model ran on)"""
+    gate = EnergyGate(OpenWakeWordDetector.frame_length, sample_rate) if gated else None
+    detector = OpenWakeWordDetector(model, gate=gate)
+    detector.reset()
+    frame_length = OpenWakeWordDetector.frame_length
+    frames = [pcm[i:i + frame_length] for i in range(0, len(pcm) - frame_length + 1, frame_length)]
+
+    cpu_start = time.process_time()
+    for frame in frames:
+        detector.process(frame)
+    cpu = time.process_time() - cpu_start
+
+    audio_seconds = len(frames) * frame_length / sample_rate
+    passed = gate.frames_passed / len(frames) if gate else 1.0
+    return cpu / audio_seconds * 3600, passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=120, help="Seconds of synthetic audio per room")
+    parser.add_argument("--idle-wav", help="16kHz mono 16-bit recording of a quiet room")
+    parser.add_argument("--active-wav", help="16kHz mono 16-bit recording of a room with people talking")
+    parser.add_argument("--wake-word", action="append",
+                        help=f"openWakeWord model; repeatable. Default: {Listener._oww_wake_words}")
+    args = parser.parse_args()
+
+    wake_words = args.wake_word or Listener._oww_wake_words
+    Listener._ensure_oww_models(wake_words)
+    from openwakeword.model import Model
+    model = Model(wakeword_models=wake_words, inference_framework="onnx")
+
+    rooms = {
+        "idle": read_wav(args.idle_wav) if args.idle_wav else quiet_room_pcm(args.seconds),
+        "active": read_wav(args.active_wav) if args.active_wav else synthetic_pcm(args.seconds),
+    }
+    print(f"CPU: {platform.machine()} {platform.processor() or ''}, {os.cpu_count()} cores; "
+          f"models: {wake_words}")
+    print(f"{'room':<8}{'gate':<6}{'CPU s/hour':>12}{'% of a core':>13}{'frames run':>12}")
+    for room, pcm in rooms.items():
+        for gated in (False, True):
+            cpu_per_hour, passed = measure(model, pcm, gated)
+            print(f"{room:<8}{'on' if gated else 'off':<6}{cpu_per_hour:>12.1f}{cpu_per_hour / 36:>12.2f}%"
+                  f"{passed:>12.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,14 @@ import logging
 import os
 import threading
 import time
-from collections import defaultdict
+from collections import OrderedDict
 
 import pygame
 
+from image_writer import image_writer
+from inference_clients import EncodedImage
+from metrics import metrics
+
 logger = logging.getLogger(__name__)
 
 
@@ -33,12 +37,191 @@ class Animation:
         return frames
 
 
+class AnimationScheduler:
+    """Keeps the timeline of the running animations, which are drawn by the render loop.
+    The frame to show is picked from the time elapsed since the animation started, so a late tick skips frames instead
+    of slowing the animation down, and the loop can sleep until exactly when the next frame is due.
+    """
+
+    def __init__(self):
+        self._running = dict()  # animation_id -> [animation, start time, index of the last frame drawn]
+        self._lock = threading.Lock()
+        self.frames_dropped = 0
+
+    def start(self, animation_id, animation):
+        with self._lock:
+            self._running[animation_id] = [animation, time.monotonic(), -1]
+
+    def stop(self, animation_id):
+        with self._lock:
+            self._running.pop(animation_id, None)
+
+    def stop_all(self):
+        with self._lock:
+            self._running.clear()
+
+    def is_running(self):
+        with self._lock:
+            return bool(self._running)
+
+    def due_frames(self, now):
+        """Returns (animation, frame) for every animation whose frame has changed since it was last drawn"""
+        frames = list()
+        with self._lock:
+            for state in self._running.values():
+                animation, start, last_index = state
+                index = int((now - start) * animation.fps)
+                if index == last_index:
+                    continue
+                if last_index >= 0 and index - last_index > 1:
+                    self.frames_dropped += index - last_index - 1
+                    metrics.increment("dropped_frames", index - last_index - 1)
+                state[2] = index
+                frames.append((animation, animation.frames[index % animation.num_frames]))
+        return frames
+
+    def time_to_next_frame(self, now):
+        """Seconds until the next frame of any animation is due, or None if nothing is animating"""
+        with self._lock:
+            if not self._running:
+                return None
+            return max(0.0, min(start + (last_index + 1) / animation.fps - now
+                                for animation, start, last_index in self._running.values()))
+
+
+class SurfaceCache:
+    """Memory-bounded LRU of images that are already decoded, scaled and converted to the display's pixel format,
+    so that showing one of them again is a single blit"""
+
+    def __init__(self, max_bytes=64 * 1024 ** 2):
+        self._max_bytes = max_bytes
+        self._surfaces = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _surface_bytes(surface):
+        return surface.get_pitch() * surface.get_height()
+
+    def get(self, key):
+        with self._lock:
+            surface = self._surfaces.get(key)
+            if surface is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._surfaces.move_to_end(key)
+            return surface
+
+    def put(self, key, surface):
+        size = self._surface_bytes(surface)
+        if size > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._surfaces:
+                self._bytes -= self._surface_bytes(self._surfaces.pop(key))
+            self._surfaces[key] = surface
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, evicted = self._surfaces.popitem(last=False)
+                self._bytes -= self._surface_bytes(evicted)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._surfaces),
+                "bytes": self._bytes,
+            }
+
+
+class TextLayout:
+    """Text wrapped into lines within `rect`, top down, with the lines kept as they were drawn. When the text changes,
+    only the lines from the first changed one onwards are rendered and drawn again; for a live transcript that's
+    usually just the last line. If the text doesn't fit, its last lines are shown."""
+
+    def __init__(self, font, color, background, rect, line_spacing=1.2):
+        self._font = font
+        self._color = color
+        self._background = background
+        self._rect = rect
+        self._line_height = int(font.get_linesize() * line_spacing)
+        self._max_lines = max(1, rect.height // self._line_height)
+        self._lines = list()  # (text, surface) of the lines on screen
+        self._cleared = False
+
+    def reset(self):
+        """Forgets what's on screen, e.g. after the screen has been drawn over"""
+        self._lines = list()
+        self._cleared = False
+
+    def _wrap(self, text):
+        lines = list()
+        line = str()
+        for word in text.split():
+            candidate = f"{line} {word}" if line else word
+            # A word too long for a line of its own is cut off
+            if line and self._font.size(candidate)[0] > self._rect.width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        if line:
+            lines.append(line)
+        return lines[-self._max_lines:]
+
+    def _line_rect(self, i):
+        return pygame.Rect(self._rect.left, self._rect.top + i * self._line_height, self._rect.width, self._line_height)
+
+    def draw(self, surface, text):
+        """Draws `text` over what was drawn before and returns the regions that changed"""
+        dirty_rects = list()
+        if not self._cleared:
+            dirty_rects.append(surface.fill(self._background, self._rect))
+            self._cleared = True
+            self._lines = list()
+
+        # Lines that scrolled up are rendered already
+        rendered = dict(self._lines)
+        lines = list()
+        clip = surface.get_clip()
+        surface.set_clip(self._rect)
+        for i, line in enumerate(self._wrap(text)):
+            if i < len(self._lines) and self._lines[i][0] == line:
+                lines.append(self._lines[i])
+                continue
+            line_surface = rendered.get(line) or self._font.render(line, True, self._color)
+            line_rect = self._line_rect(i)
+            surface.fill(self._background, line_rect)
+            surface.blit(line_surface, line_surface.get_rect(center=line_rect.center))
+            dirty_rects.append(line_rect.clip(self._rect))
+            lines.append((line, line_surface))
+
+        # The text may have got shorter
+        for i in range(len(lines), len(self._lines)):
+            dirty_rects.append(surface.fill(self._background, self._line_rect(i)))
+        surface.set_clip(clip)
+        self._lines = lines
+        return dirty_rects
+
+
 class Displayer:
     # Define colors
     BLACK = (0, 0, 0)
     WHITE = (255, 255, 255)
 
-    def __init__(self):
+    # Posted to wake up the render loop from its idle wait when something has been drawn
+    _REDRAW_EVENT = pygame.USEREVENT + 1
+
+    def __init__(self, surface_cache_bytes=64 * 1024 ** 2, idle_timeout=1.0):
+        """
+        idle_timeout: Seconds the render loop sleeps at most while nothing is animating
+        """
         # Initialize Pygame
         pygame.init()
 
@@ -56,11 +239,17 @@ class Displayer:
 
         self._app_running = threading.Event()
 
-        # This keeps track of animations
-        self._running_animations = defaultdict(threading.Event)
-        self._running_animations_lock = threading.Lock()
+        # Regions of the screen drawn since the last display update. Guarded by `_screen_lock`.
+        self._dirty_rects = list()
+        self._idle_timeout = idle_timeout
+        self._frames_drawn = 0
+        self._idle_time = 0.0
+
+        # This keeps track of animations, which are all drawn from the render loop
+        self._animations = AnimationScheduler()
 
-        self._all_threads = list()
+        # Recently shown images, ready to be blitted
+        self._surface_cache = SurfaceCache(max_bytes=surface_cache_bytes)
 
         self._dream_text_props = {
             "font_style": None,
@@ -76,6 +265,17 @@ class Displayer:
                                             self._dream_text_props["center"][1] + self._dream_text_props[
                                                 "font_size"] // 2)
 
+        # Loading a font from disk is slow, so every font is only loaded once
+        self._fonts = dict()
+        # The transcript is laid out by the render loop, at most once per frame, however often it changes.
+        # Both are guarded by `_screen_lock`.
+        self._dream_text_layout = TextLayout(self._get_font(self._dream_text_props["font_style"],
+                                                            self._dream_text_props["font_size"]),
+                                             color=self._dream_text_props["font_color"],
+                                             background=self.WHITE,
+                                             rect=self._dream_text_rect.inflate(-self._screen.get_width() // 20, 0))
+        self._pending_dream_text = None
+
         self._listening_anim = Animation(sprite_sheet_path="assets/mic_spritesheet.png",
                                          num_frames=24,
                                          fps=33.33,
@@ -101,25 +301,59 @@ class Displayer:
         return self._screen.get_width(), self._screen.get_height()
 
     def show_image(self, image_path="assets/logo.jpeg", size=None, center=None):
-        if not image_path or not os.path.exists(image_path):
+        if not image_path or not image_writer.exists(image_path):
             logger.error(f"Could not locate image at {image_path}")
             return
 
-        # Load an image
-        image = pygame.image.load(image_path)
-
         size, center = self._get_defaults(size=size, center=center)
 
-        image = pygame.transform.scale(image, size)
+        image = self._load_image(image_path, size)
 
         # Render the image
         image_rect = image.get_rect(center=center)
-        with self._screen_lock:
-            self._screen.blit(image, image_rect)
+        with self._screen_lock, metrics.span("image_blit"):
+            self._drop_dream_text()
+            self._mark_dirty(self._screen.blit(image, image_rect))
+
+    def _load_image(self, image_path, size):
+        """Returns the image decoded, scaled to `size` and in the display's pixel format, from cache when possible.
+        An image that is still on its way to disk is decoded from memory."""
+        in_memory = image_writer.get(image_path)
+        # mtime is part of the key so that an image overwritten on disk is not shown stale
+        key = (os.path.abspath(image_path), None if in_memory else os.path.getmtime(image_path), tuple(size))
+        image = self._surface_cache.get(key)
+        if image is None:
+            metrics.increment("surface_cache_misses")
+            with metrics.span("image_decode"):
+                image = self._surface_from_memory(in_memory) if in_memory else pygame.image.load(image_path)
+            with metrics.span("image_scale"):
+                image = pygame.transform.scale(image, size).convert()
+            self._surface_cache.put(key, image)
+        else:
+            metrics.increment("surface_cache_hits")
+        return image
+
+    @staticmethod
+    def _surface_from_memory(image):
+        """image: EncodedImage or PIL image"""
+        if isinstance(image, EncodedImage):
+            image = image.image
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        return pygame.image.frombuffer(image.tobytes(), image.size, image.mode)
+
+    def get_surface_cache_stats(self):
+        return self._surface_cache.stats()
+
+    def _get_font(self, font_style, font_size):
+        key = (font_style, font_size)
+        font = self._fonts.get(key)
+        if font is None:
+            font = self._fonts[key] = pygame.font.Font(font_style, font_size)  # None uses the default font
+        return font
 
     def _show_text(self, text, font_style=None, font_size=75, font_color=(0, 0, 0), center=None):
-        # Define a font
-        font = pygame.font.Font(font_style, font_size)  # None uses the default font
+        font = self._get_font(font_style, font_size)
 
         center = self._get_defaults(center=center)
 
@@ -129,75 +363,117 @@ class Displayer:
         text_rect = text.get_rect(center=center)
 
         with self._screen_lock:
-            self._screen.blit(text, text_rect)
-
-    def _show_animation(self, animation, animation_id):
-        """Displays animation using frames from a spritesheet"""
-
-        frame_index = 0
-
-        with self._running_animations_lock:
-            self._running_animations[animation_id].set()
-
-        while True:
-            with self._running_animations_lock:
-                if not self._running_animations[animation_id].is_set():
-                    break
-            frame = animation.frames[frame_index % animation.num_frames]
-            with self._screen_lock:
-                self._screen.blit(frame, frame.get_rect(center=animation.center))
-            t0 = time.time()
-            while time.time() - t0 < 1 / animation.fps:
-                time.sleep(0.001)
-            frame_index += 1
+            self._mark_dirty(self._screen.blit(text, text_rect))
 
     def show_loading(self):
         """This is displayed while waiting for image to be generated"""
-        thread = threading.Thread(target=self._show_animation,
-                                  kwargs={"animation": self._loading_anim, "animation_id": "loading"},
-                                  daemon=True)
-        self._all_threads.append(thread)
-        thread.start()
+        self._animations.start("loading", self._loading_anim)
+        self._wake_render_loop()
 
     def show_listening(self):
         """This is displayed as soon as the wake phrase is heard. It shows the voice prompt in real-time"""
-        thread = threading.Thread(target=self._show_animation,
-                                  kwargs={"animation": self._listening_anim, "animation_id": "listening"},
-                                  daemon=True)
-        self._all_threads.append(thread)
-        thread.start()
+        self._animations.start("listening", self._listening_anim)
+        self._wake_render_loop()
 
     def stop_show_listening(self):
-        self._running_animations["listening"].clear()
+        self._animations.stop("listening")
 
     def stop_show_loading(self):
-        self._running_animations["loading"].clear()
+        self._animations.stop("loading")
 
     def show_dream_prompt(self, dream_text):
+        """Transcripts that come in faster than frames are drawn replace each other; only the latest one is drawn"""
         with self._screen_lock:
-            pygame.draw.rect(self._screen, self.WHITE, self._dream_text_rect)
+            if self._pending_dream_text is not None:
+                metrics.increment("transcript_updates_coalesced")
+            else:
+                self._wake_render_loop()
+            self._pending_dream_text = dream_text
 
-        self._show_text(dream_text,
-                        **self._dream_text_props)
+    def _draw_dream_text(self):
+        with self._screen_lock:
+            if self._pending_dream_text is None:
+                return
+            dream_text, self._pending_dream_text = self._pending_dream_text, None
+            with metrics.span("text_layout"):
+                # No need to wake up the render loop; this is the render loop
+                self._dirty_rects.extend(self._dream_text_layout.draw(self._screen, dream_text))
+
+    def _drop_dream_text(self):
+        """The transcript is about to be drawn over. Has to be called with `_screen_lock` held."""
+        self._pending_dream_text = None
+        self._dream_text_layout.reset()
 
     def show_message(self, msg):
         self.clear_screen()
         self._show_text(msg)
 
+    def _wake_render_loop(self):
+        pygame.event.post(pygame.event.Event(self._REDRAW_EVENT))
+
+    def _mark_dirty(self, rect):
+        """Registers a region drawn on the screen. Has to be called with `_screen_lock` held."""
+        if not self._dirty_rects:
+            # The render loop may be idle
+            self._wake_render_loop()
+        self._dirty_rects.append(rect)
+
+    def _draw_animation_frames(self):
+        frames = self._animations.due_frames(time.monotonic())
+        if not frames:
+            return
+        with self._screen_lock:
+            for animation, frame in frames:
+                # No need to wake up the render loop; this is the render loop
+                self._dirty_rects.append(self._screen.blit(frame, frame.get_rect(center=animation.center)))
+
+    def _update_display(self):
+        with self._screen_lock:
+            if not self._dirty_rects:
+                return
+            with metrics.span("display_update"):
+                pygame.display.update(self._dirty_rects)
+            self._dirty_rects = list()
+        self._frames_drawn += 1
+
+    def get_render_stats(self):
+        return {
+            "frames_drawn": self._frames_drawn,
+            "idle_time": self._idle_time,
+            "frames_dropped": self._animations.frames_dropped,
+        }
+
     def run(self):
         # Main loop
-        clock = pygame.time.Clock()
         self._app_running.set()
         while self._app_running.is_set():
-            for event in pygame.event.get():
+            # Sleep until the next animation frame is due, or until something gets drawn (or there is an input event)
+            timeout = self._animations.time_to_next_frame(time.monotonic())
+            if timeout is None:
+                timeout = self._idle_timeout
+            timeout_ms = int(timeout * 1000)
+
+            if timeout_ms > 0:
+                t0 = time.monotonic()
+                # A timeout of 0 would make pygame wait forever
+                events = [pygame.event.wait(timeout_ms)] + pygame.event.get()
+                self._idle_time += time.monotonic() - t0
+            else:
+                events = pygame.event.get()
+
+            for event in events:
                 if event.type == pygame.QUIT:  # Quit event
                     self._app_running.clear()
                 if event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:  # Exit on ESC
                     self._app_running.clear()
 
-            pygame.display.flip()
-            clock.tick(30)
+            self._draw_animation_frames()
+            self._draw_dream_text()
+
+            # Only the regions that changed are pushed to the display
+            self._update_display()
 
+        logger.info(f"Render stats: {self.get_render_stats()}")
         self.shutdown()
 
     def clear_screen(self, color=None):
@@ -206,19 +482,18 @@ class Displayer:
 
         # Fill the screen with a background color
         with self._screen_lock:
-            self._screen.fill(color)
+            self._drop_dream_text()
+            self._mark_dirty(self._screen.fill(color))
 
     def show_startup(self):
         self.show_image("assets/logo.jpeg")
+        # The render loop may not be running yet
+        self._update_display()
 
     def shutdown(self):
-        with self._running_animations_lock:
-            for key in self._running_animations:
-                self._running_animations[key].clear()
+        self._animations.stop_all()
         # Quit Pygame
         # This can be called multiple times as repeated calls have no effect
-        for th in self._all_threads:
-            th.join()
         pygame.quit()
 
     def __enter__(self):
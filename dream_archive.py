@@ -0,0 +1,256 @@
+import hashlib
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DreamArchive:
+    """Every dream ever kept, with where it came from: prompt, provider, model, size, steps, generation latency and
+    when it was made. Backed by SQLite in `archive_dir`.
+    Keys (and so are the image names) are hashes, so that different prompts can't collide. The keys and sampling weights
+    are also held in memory, so that a random past dream is picked in O(1), without listing the directory.
+    Once over `max_bytes` or `max_count`, the least recently used (shown, or reused from the cache) dreams are deleted,
+    except for pinned ones (e.g. the dream on screen, see `pin`). Dreams can be added before they are shown (`shown=False`, e.g. prefetched ones): they
+    are neither sampled as past dreams nor evicted until `mark_shown`.
+    """
+    _db_file_name = ".archive.sqlite3"
+    _image_extensions = (".jpeg", ".jpg", ".png", ".webp")
+
+    def __init__(self, archive_dir="dreams", max_bytes=2 * 1024 ** 3, max_count=None):
+        self._archive_dir = archive_dir
+        self._max_bytes = max_bytes
+        self._max_count = max_count
+        self._lock = threading.Lock()
+        os.makedirs(archive_dir, exist_ok=True)
+        db_path = os.path.join(archive_dir, self._db_file_name)
+        is_new = not os.path.isfile(db_path)
+        # Used from the app's threads, always under `_lock`
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS dreams (
+                                key TEXT PRIMARY KEY,
+                                path TEXT NOT NULL,
+                                prompt TEXT,
+                                provider TEXT,
+                                model TEXT,
+                                width INTEGER,
+                                height INTEGER,
+                                steps INTEGER,
+                                latency REAL,
+                                created REAL,
+                                last_used REAL,
+                                size INTEGER,
+                                weight REAL NOT NULL DEFAULT 1.0,
+                                shown INTEGER NOT NULL DEFAULT 1)""")
+        if "shown" not in [column[1] for column in self._db.execute("PRAGMA table_info(dreams)")]:
+            self._db.execute("ALTER TABLE dreams ADD COLUMN shown INTEGER NOT NULL DEFAULT 1")
+        self._db.execute("CREATE INDEX IF NOT EXISTS dreams_last_used ON dreams (last_used)")
+        self._db.commit()
+        self._pinned = set()
+
+        # For sampling: keys[i] has weights[i]; positions maps a key back to i
+        self._keys = list()
+        self._weights = list()
+        self._positions = dict()
+        self._max_weight = 0.0
+        self._total_bytes = 0
+        for key, weight, size, shown in self._db.execute("SELECT key, weight, size, shown FROM dreams"):
+            if shown:
+                self._index(key, weight)
+            self._total_bytes += size or 0
+
+        if is_new:
+            self._import_untracked_images()
+
+    def _index(self, key, weight):
+        if key in self._positions:
+            self._weights[self._positions[key]] = weight
+        else:
+            self._positions[key] = len(self._keys)
+            self._keys.append(key)
+            self._weights.append(weight)
+        self._max_weight = max(self._max_weight, weight)
+
+    def _unindex(self, key):
+        # Swap with the last one, so that removal is O(1) as well
+        position = self._positions.pop(key)
+        last_key, last_weight = self._keys.pop(), self._weights.pop()
+        removed_weight = last_weight
+        if position < len(self._keys):
+            removed_weight = self._weights[position]
+            self._keys[position], self._weights[position] = last_key, last_weight
+            self._positions[last_key] = position
+        if removed_weight >= self._max_weight:
+            self._max_weight = max(self._weights, default=0.0)
+
+    def _import_untracked_images(self):
+        """Adopts images saved before there was an archive, e.g. under their prompt as name, renaming them to hashes"""
+        for file_name in sorted(os.listdir(self._archive_dir)):
+            path = os.path.join(self._archive_dir, file_name)
+            stem, extension = os.path.splitext(file_name)
+            if file_name.startswith(".") or extension.lower() not in self._image_extensions or not os.path.isfile(path):
+                continue
+            if self._is_key(stem):
+                key, new_path, prompt = stem, path, None
+            else:
+                with open(path, "rb") as f:
+                    key = hashlib.sha256(f.read()).hexdigest()
+                new_path, prompt = os.path.join(self._archive_dir, f"{key}{extension.lower()}"), stem
+                os.replace(path, new_path)
+            self.add(key, new_path, prompt=prompt, created=os.path.getmtime(new_path))
+            logger.info(f"Imported {path} into the dream archive as {new_path}")
+
+    @staticmethod
+    def _is_key(name):
+        return len(name) == 64 and all(c in "0123456789abcdef" for c in name)
+
+    @property
+    def archive_dir(self):
+        return self._archive_dir
+
+    def path_for(self, key, extension=".jpeg"):
+        return os.path.join(self._archive_dir, f"{key}{extension}")
+
+    def add(self, key, path, prompt=None, provider=None, model=None, width=None, height=None, steps=None, latency=None,
+            weight=1.0, created=None, shown=True):
+        """Adds (or replaces) a dream whose image is already at `path`
+        weight: How likely the dream is to be sampled, relative to the others
+        shown: False for a dream that hasn't been on screen yet; see `mark_shown`
+        """
+        now = time.time()
+        size = os.path.getsize(path)
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM dreams WHERE key = ?", (key,)).fetchone()
+            if previous:
+                self._total_bytes -= previous[0] or 0
+            self._db.execute("INSERT OR REPLACE INTO dreams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (key, path, prompt, str(provider) if provider else None, model, width, height, steps,
+                              latency, created or now, now, size, weight, int(shown)))
+            self._total_bytes += size
+            if shown:
+                self._index(key, weight)
+            elif key in self._positions:
+                self._unindex(key)
+            self._evict(keep=key)
+            self._db.commit()
+
+    def mark_shown(self, key):
+        """Marks the dream as used just now, as it went up on screen, e.g. again as a past dream. One added with
+        `shown=False` becomes a past dream like any other."""
+        with self._lock:
+            row = self._db.execute("SELECT weight, shown FROM dreams WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return
+            weight, shown = row
+            self._db.execute("UPDATE dreams SET shown = 1, last_used = ? WHERE key = ?", (time.time(), key))
+            if not shown:
+                self._index(key, weight)
+                self._evict(keep=key)
+            self._db.commit()
+
+    def pin(self, key):
+        """Keeps the dream from being evicted, e.g. while it is on screen"""
+        with self._lock:
+            self._pinned.add(key)
+
+    def unpin(self, key):
+        with self._lock:
+            self._pinned.discard(key)
+
+    def get(self, key):
+        """Returns the path of the dream and marks it as recently used, or None if it isn't archived"""
+        with self._lock:
+            row = self._db.execute("SELECT path FROM dreams WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            if not os.path.isfile(row[0]):
+                self._delete(key, row[0], remove_file=False)
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE dreams SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return row[0]
+
+    def contains(self, key):
+        """Like `get`, but without marking the dream as used"""
+        with self._lock:
+            row = self._db.execute("SELECT path FROM dreams WHERE key = ?", (key,)).fetchone()
+            return bool(row) and os.path.isfile(row[0])
+
+    def metadata(self, key):
+        with self._lock:
+            cursor = self._db.execute("SELECT * FROM dreams WHERE key = ?", (key,))
+            row = cursor.fetchone()
+            return dict(zip((column[0] for column in cursor.description), row)) if row else None
+
+    def set_weight(self, key, weight):
+        with self._lock:
+            if key not in self._positions:
+                return
+            self._db.execute("UPDATE dreams SET weight = ? WHERE key = ?", (weight, key))
+            self._db.commit()
+            self._index(key, weight)
+
+    def sample(self, weighted=True, max_tries=10):
+        """Returns the path of a random dream, or None if the archive is empty
+        weighted: Pick dreams in proportion to their weight (by rejection, so still O(1) as long as the weights are
+            within a small factor of each other), rather than uniformly
+        """
+        with self._lock:
+            for attempt in range(max_tries):
+                if not self._keys:
+                    return None
+                position = random.randrange(len(self._keys))
+                # The last try takes whatever it gets, so that a run of bad luck doesn't come back empty
+                if weighted and attempt < max_tries - 1 and \
+                        random.random() * self._max_weight > self._weights[position]:
+                    continue
+                key = self._keys[position]
+                path = self._db.execute("SELECT path FROM dreams WHERE key = ?", (key,)).fetchone()[0]
+                if os.path.isfile(path):
+                    return path
+                # Deleted behind our back
+                self._delete(key, path, remove_file=False)
+                self._db.commit()
+            return None
+
+    def _delete(self, key, path, remove_file=True):
+        size = self._db.execute("SELECT size FROM dreams WHERE key = ?", (key,)).fetchone()[0]
+        self._db.execute("DELETE FROM dreams WHERE key = ?", (key,))
+        self._total_bytes -= size or 0
+        if key in self._positions:
+            self._unindex(key)
+        if remove_file:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Could not remove {path}: {e}")
+
+    def _evict(self, keep):
+        # The dream just added is never evicted, even if it alone is over the budget, and neither are pinned dreams or
+        # those that are yet to be shown
+        protected = sorted(self._pinned | {keep})
+        placeholders = ", ".join("?" * len(protected))
+        while self._total_bytes > self._max_bytes or (self._max_count is not None and len(self._keys) > self._max_count):
+            row = self._db.execute(f"SELECT key, path, prompt FROM dreams WHERE shown = 1 AND key NOT IN "
+                                   f"({placeholders}) ORDER BY last_used LIMIT 1", protected).fetchone()
+            if not row:
+                break
+            key, path, prompt = row
+            self._delete(key, path)
+            logger.info(f"Evicted {path} ('{prompt}') from the dream archive")
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "dreams": len(self._keys),
+                "bytes": self._total_bytes,
+            }
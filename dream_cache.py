@@ -0,0 +1,106 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from image_writer import image_writer
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DreamCache:
+    """Content-addressed prompt-to-image cache on top of the dream archive.
+    The key is a hash of the normalized prompt and the generation parameters, and is what the dream is archived (and
+    its image named) under. The archive's retention policy evicts the least recently used dreams first, and a cache hit
+    counts as a use.
+    """
+    # Where the cache kept its entries before there was an archive
+    _legacy_index_file_name = ".cache_index.json"
+
+    def __init__(self, archive):
+        self._archive = archive
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._pending = dict()  # key -> path of an image that is still being written, see `add_pending`
+        self._import_legacy_index(os.path.join(archive.archive_dir, self._legacy_index_file_name))
+
+    @staticmethod
+    def normalize_prompt(text):
+        """Case, whitespace and trailing punctuation do not change the dream"""
+        return " ".join(text.lower().split()).strip(" .,!?")
+
+    @classmethod
+    def make_key(cls, text, width, height, model, steps):
+        params = [cls.normalize_prompt(text), width, height, model, steps]
+        return hashlib.sha256(json.dumps(params).encode("utf-8")).hexdigest()
+
+    def path_for(self, key):
+        return self._archive.path_for(key)
+
+    def _import_legacy_index(self, index_path):
+        try:
+            with open(index_path, "r") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read cache index {index_path}: {e}")
+            return
+        # Least recently used first, so that the order survives
+        for key, entry in entries:
+            if os.path.isfile(entry["path"]):
+                self._archive.add(key, entry["path"], prompt=entry["prompt"], created=entry["ts"])
+        os.remove(index_path)
+        logger.info(f"Moved {len(entries)} cache entries from {index_path} into the dream archive")
+
+    def add_pending(self, key, path):
+        """Makes `key` a hit right away, while its image is still waiting for the ImageWriter (which serves it from
+        memory in the meantime). `put` replaces it with the archived dream once the image is written."""
+        with self._lock:
+            self._pending[key] = path
+
+    def _pending_path(self, key):
+        with self._lock:
+            path = self._pending.get(key)
+            if path and not image_writer.exists(path):
+                # The write failed
+                del self._pending[key]
+                return None
+            return path
+
+    def get(self, key):
+        """Returns the path of the cached image, or None on a miss"""
+        path = self._archive.get(key) or self._pending_path(key)
+        with self._lock:
+            if not path:
+                self.misses += 1
+                metrics.increment("cache_misses")
+                return None
+            self.hits += 1
+            metrics.increment("cache_hits")
+            return path
+
+    def contains(self, key):
+        """Like `get`, but without counting as a lookup or making the entry more recent"""
+        return self._archive.contains(key) or self._pending_path(key) is not None
+
+    def put(self, key, path, prompt, **metadata):
+        """metadata: Anything else the archive keeps about the dream, e.g. provider or latency"""
+        self._archive.add(key, path, prompt=prompt, **metadata)
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def stats(self):
+        archive_stats = self._archive.stats()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": archive_stats["dreams"],
+                "bytes": archive_stats["bytes"],
+            }
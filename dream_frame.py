@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import threading
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin
+from urllib.request import Request, urlopen
+
+logger = logging.getLogger(__name__)
+
+
+class DreamFrame:
+    """Thin frame that shows the dreams of a DreamServer. It needs no access keys and does no inference, and it gets
+    new dreams pushed as server-sent events. Images are kept in `cache_dir` under their content hash, so each one is
+    only downloaded once."""
+
+    def __init__(self, server_url, displayer, cache_dir=os.path.join("dreams", "frame"), max_cached_images=20,
+                 retry_interval=5, timeout=60):
+        """
+        server_url: e.g. http://127.0.0.1:8700/
+        displayer: Anything with `show_image(path)` and a blocking `run()`, normally a Displayer
+        retry_interval: Seconds to wait before reconnecting to the server
+        timeout: Seconds without any data (the server sends keep-alives) after which the connection is given up on
+        """
+        self._server_url = server_url
+        self._displayer = displayer
+        self._cache_dir = cache_dir
+        self._max_cached_images = max_cached_images
+        self._retry_interval = retry_interval
+        self._timeout = timeout
+        self._etag = None
+        self._running = threading.Event()
+        self.dreams_shown = 0
+
+    def _url(self, path):
+        return urljoin(self._server_url, path)
+
+    def _sync_current(self):
+        """Fetches the current dream, unless it's the one on screen already"""
+        headers = {"If-None-Match": self._etag} if self._etag else dict()
+        try:
+            with urlopen(Request(self._url("/dreams/current"), headers=headers), timeout=self._timeout) as response:
+                self._show(json.load(response), response.headers.get("ETag"))
+        except HTTPError as e:
+            if e.code not in (304, 404):
+                raise
+
+    def _listen_for_events(self):
+        headers = {"Accept": "text/event-stream"}
+        if self._etag:
+            headers["Last-Event-ID"] = self._etag
+        with urlopen(Request(self._url("/events"), headers=headers), timeout=self._timeout) as response:
+            event, data, event_id = None, list(), None
+            for line in response:
+                if not self._running.is_set():
+                    return
+                line = line.decode("utf-8").rstrip("\r\n")
+                if line.startswith(":"):
+                    continue
+                if line:
+                    field, _, value = line.partition(":")
+                    value = value[1:] if value.startswith(" ") else value
+                    if field == "event":
+                        event = value
+                    elif field == "data":
+                        data.append(value)
+                    elif field == "id":
+                        event_id = value
+                    continue
+                # A blank line ends the event
+                if event == "dream" and data:
+                    self._show(json.loads("\n".join(data)), event_id)
+                event, data, event_id = None, list(), None
+
+    def _show(self, dream, etag):
+        dream_img = self._fetch_image(dream)
+        self._displayer.show_image(dream_img)
+        self._etag = etag
+        self.dreams_shown += 1
+        logger.info(f"Showing dream {dream['id']} ('{dream.get('prompt')}')")
+
+    def _fetch_image(self, dream):
+        path = os.path.join(self._cache_dir, os.path.basename(dream["image"]))
+        if os.path.isfile(path):
+            # Touched, so that recently shown images are the last to be pruned
+            os.utime(path)
+            return path
+
+        os.makedirs(self._cache_dir, exist_ok=True)
+        with urlopen(self._url(dream["image"]), timeout=self._timeout) as response:
+            data = response.read()
+        tmp_path = os.path.join(self._cache_dir, f".tmp-{os.path.basename(path)}")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._prune_cache()
+        return path
+
+    def _prune_cache(self):
+        images = sorted((entry for entry in os.scandir(self._cache_dir)
+                         if entry.is_file() and not entry.name.startswith(".")),
+                        key=lambda entry: entry.stat().st_mtime)
+        for entry in images[:-self._max_cached_images]:
+            os.remove(entry.path)
+
+    def _follow(self):
+        while self._running.is_set():
+            try:
+                # Catches up on whatever was missed while disconnected, then waits for pushes
+                self._sync_current()
+                self._listen_for_events()
+            except (OSError, URLError, ValueError) as e:
+                if self._running.is_set():
+                    logger.error(f"Lost connection to {self._server_url}: {e}; retrying in {self._retry_interval}s")
+            if self._running.is_set():
+                time.sleep(self._retry_interval)
+
+    def start(self):
+        self._running.set()
+        threading.Thread(target=self._follow, daemon=True).start()
+
+    def stop(self):
+        self._running.clear()
+
+    def run(self):
+        self.start()
+        try:
+            self._displayer.run()  # This has to be part of main thread
+        finally:
+            self.stop()
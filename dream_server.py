@@ -0,0 +1,286 @@
+import hmac
+import ipaddress
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from image_writer import image_writer
+from inference_clients import EncodedImage
+
+logger = logging.getLogger(__name__)
+
+
+class DreamServer:
+    """Generates dreams once for a whole fleet of frames and serves them over HTTP, so that a frame needs neither access
+    keys nor a Dreamer of its own (see DreamFrame).
+
+        GET  /dreams/current    The dream all frames should show, as JSON. Supports If-None-Match; with ?wait=<seconds>
+                                it waits for a newer dream before answering 304 (long polling).
+        GET  /events            Server-sent events: a `dream` event with the same JSON every time the dream changes
+        GET  /images/<name>     Image of a dream. Names are content hashes, so images are cached by the frames for good.
+        POST /dreams            Dreams {"prompt": ...} now and shows it on all frames; without a prompt, a random dream.
+                                As that is paid for, it needs "Authorization: Bearer <token>" if the server has a token.
+    """
+
+    def __init__(self, dreamer, host="127.0.0.1", port=8700, image_size=(1824, 1024), period=86400, prefetcher=None,
+                 dreams_dir="dreams", keepalive_interval=15, token=None):
+        """
+        host: Interface to listen on; "0.0.0.0" to serve frames on other devices, which needs a `token`
+        token: Shared secret that POST /dreams has to present; without one, anybody who can reach the server could
+            spend the providers' budget
+        port: 0 picks a free port, see `port`
+        image_size: (width, height) of the dreams; every frame scales them to its screen
+        period: Seconds between periodic dreams
+        prefetcher: DreamPrefetcher to take periodic dreams from, if any
+        keepalive_interval: Seconds between comments sent on idle event streams, so that dead frames are noticed
+        """
+        if token is None and not _is_loopback(host):
+            raise ValueError(f"Serving on {host} needs a token, or anybody on the network could generate paid dreams")
+        self._dreamer = dreamer
+        self._token = token
+        self._image_size = image_size
+        self._period = period
+        self._prefetcher = prefetcher
+        self._dreams_dir = dreams_dir
+        self._keepalive_interval = keepalive_interval
+        self._cond = threading.Condition()
+        self._current = None
+        self._running = threading.Event()
+        self._http_server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._http_server.daemon_threads = True
+        self.generated = 0
+
+    @property
+    def port(self):
+        return self._http_server.server_address[1]
+
+    def current(self):
+        with self._cond:
+            return self._current
+
+    def publish(self, dream_img, prompt=None):
+        """Makes `dream_img` the dream of all frames"""
+        name = os.path.basename(dream_img)
+        dream = {"id": os.path.splitext(name)[0], "image": f"/images/{name}", "prompt": prompt, "ts": time.time()}
+        self._dreamer.mark_shown(dream_img)
+        with self._cond:
+            self._current = dream
+            self._cond.notify_all()
+        logger.info(f"Published {dream_img} to the frames")
+        return dream
+
+    def dream(self, prompt=None):
+        """Visualizes `prompt` (or a random dream) and publishes it. Returns the dream, or None if it failed."""
+        prompt = prompt or self._dreamer.imagine()
+        dream_img = self._dreamer.visualize(prompt, width=self._image_size[0], height=self._image_size[1])
+        if not dream_img:
+            return None
+        with self._cond:
+            self.generated += 1
+        return self.publish(dream_img, prompt)
+
+    def _periodic_dream(self):
+        while self._running.is_set():
+            dream_img = self._prefetcher.get() if self._prefetcher else None
+            if dream_img:
+                self.publish(dream_img)
+            elif not self.dream():
+                past_dream = self._dreamer.get_random_dream()
+                if past_dream:
+                    self.publish(past_dream)
+            # The next dream is due `period` after this one, unless the server is stopped
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running.is_set(), timeout=self._period)
+
+    def start(self, periodic=True):
+        self._running.set()
+        past_dream = self._dreamer.get_random_dream()
+        if past_dream:
+            self.publish(past_dream)
+        threading.Thread(target=self._http_server.serve_forever, daemon=True).start()
+        if self._prefetcher:
+            self._prefetcher.start()
+        if periodic:
+            threading.Thread(target=self._periodic_dream, daemon=True).start()
+        logger.info(f"Serving dreams at http://{self._http_server.server_address[0]}:{self.port}/")
+
+    def stop(self):
+        with self._cond:
+            self._running.clear()
+            self._cond.notify_all()
+        if self._prefetcher:
+            self._prefetcher.stop()
+        self._http_server.shutdown()
+        self._http_server.server_close()
+
+    def run(self):
+        """Serves until interrupted"""
+        self.start()
+        try:
+            while self._running.is_set():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _wait_for_change(self, etag, timeout):
+        """Returns the current dream once its ETag differs from `etag`, or None after `timeout` seconds"""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._running.is_set() or (
+                    self._current and _etag(self._current) != etag), timeout=timeout)
+            if self._current and _etag(self._current) != etag:
+                return self._current
+            return None
+
+    def _authorized(self, authorization):
+        if self._token is None:
+            return True
+        return hmac.compare_digest((authorization or "").encode(), f"Bearer {self._token}".encode())
+
+    def _read_image(self, name):
+        """Returns the encoded image, or None if there is no such dream"""
+        # Only dreams can be fetched, nothing else on the disk
+        if os.path.basename(name) != name or name.startswith("."):
+            return None
+        path = os.path.join(self._dreams_dir, name)
+        in_memory = image_writer.get(path)
+        if isinstance(in_memory, EncodedImage):
+            return in_memory.data
+        if in_memory is not None:
+            image_writer.flush()
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/dreams/current":
+                    self._get_current(parse_qs(url.query))
+                elif url.path == "/events":
+                    self._stream_events()
+                elif url.path.startswith("/images/"):
+                    self._get_image(url.path[len("/images/"):])
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                if urlparse(self.path).path != "/dreams":
+                    self.send_error(404)
+                    return
+                if not server._authorized(self.headers.get("Authorization")):
+                    self.send_error(401, "Missing or wrong token")
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    self.send_error(400, "Expected JSON")
+                    return
+                dream = server.dream(request.get("prompt"))
+                if not dream:
+                    self.send_error(502, "Image could not be generated")
+                    return
+                self._send_json(dream, status=201)
+
+            def _get_current(self, query):
+                etag = self.headers.get("If-None-Match")
+                dream = server.current()
+                if "wait" in query and (not dream or _etag(dream) == etag):
+                    try:
+                        wait = min(max(float(query["wait"][0]), 0.0), 300)
+                    except ValueError:
+                        self.send_error(400, "wait has to be a number of seconds")
+                        return
+                    dream = server._wait_for_change(etag, timeout=wait) or dream
+                if not dream:
+                    self.send_error(404, "No dream yet")
+                elif _etag(dream) == etag:
+                    self._send_not_modified(etag)
+                else:
+                    self._send_json(dream, etag=_etag(dream))
+
+            def _get_image(self, name):
+                etag = f'"{os.path.splitext(name)[0]}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self._send_not_modified(etag)
+                    return
+                data = server._read_image(name)
+                if data is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", mimetypes.guess_type(name)[0] or "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "public, max-age=31536000, immutable")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream_events(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                # A reconnecting frame says what it has seen, so it isn't sent the same dream again
+                etag = self.headers.get("Last-Event-ID")
+                try:
+                    while server._running.is_set():
+                        dream = server._wait_for_change(etag, timeout=server._keepalive_interval)
+                        if dream:
+                            etag = _etag(dream)
+                            self.wfile.write(f"id: {etag}\nevent: dream\ndata: {json.dumps(dream)}\n\n".encode())
+                        else:
+                            self.wfile.write(b": keepalive\n\n")
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                self.close_connection = True
+
+            def _send_json(self, body, status=200, etag=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                if etag:
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_not_modified(self, etag):
+                self.send_response(304)
+                if etag:
+                    self.send_header("ETag", etag)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+
+        return Handler
+
+
+def _etag(dream):
+    return f'"{dream["id"]}"'
+
+
+def _is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
@@ -1,38 +1,141 @@
+import asyncio
+import concurrent.futures
 import glob
 import logging
 import os.path
-import random
-import concurrent.futures
-from inference_clients import HFInferenceClient, NebiusClient, TogetherClient
+import threading
+import time
+from dream_archive import DreamArchive
+from dream_cache import DreamCache
+from image_writer import image_writer
+from metrics import metrics
+from inference_clients import (AsyncHFInferenceClient, AsyncNebiusClient, AsyncTogetherClient, LazyClient,
+                               close_shared_http_client)
+from prompt_sampler import PromptSampler
+from provider_quotas import ProviderQuotas, image_cost, rate_limit_backoff, size_factor
+from provider_stats import ProviderStats
 
 logger = logging.getLogger(__name__)
 
 
+class Speculation:
+    """Image generation started from an interim transcript, ahead of the final one"""
+
+    def __init__(self, dreamer, text, height, width, steps):
+        self.text = text
+        self.started = time.monotonic()
+        self._dreamer = dreamer
+        self._params = (height, width, steps)
+        self._future = dreamer._start_generation(text, height, width, steps)
+
+    def done(self):
+        return self._future.done()
+
+    def cancel(self):
+        self._future.cancel()
+
+    def commit(self, weight=1.0):
+        """Waits for the image and archives it like `Dreamer.visualize` would have.
+        Returns (path, seconds the generation took), or (None, None) if it failed."""
+        try:
+            image, client, latency = self._future.result()
+        except concurrent.futures.CancelledError:
+            return None, None
+        if not image:
+            return None, None
+        height, width, steps = self._params
+        cache_key = DreamCache.make_key(self.text, width, height, self._dreamer._model, steps)
+        path = self._dreamer._store(self.text, image, client, latency, self._dreamer._cache.path_for(cache_key),
+                                    cache_key, height, width, steps, weight)
+        return path, latency
+
+
 class Dreamer:
     # Priority order based on the cost to use FLUX-schnell as of 2025/03/07
+    # This only breaks ties; at runtime the clients are ranked by their observed latency, error rate and cost
     _client_priority_order = (
-        TogetherClient,
-        NebiusClient,
-        HFInferenceClient,
+        AsyncTogetherClient,
+        AsyncNebiusClient,
+        AsyncHFInferenceClient,
     )
+    # All the clients serve the same model, just under different names
+    _model = "FLUX.1-schnell"
 
-    def __init__(self):
-        self._clients = self._initialize_clients()
+    def __init__(self, timeout=60, hedge_delay=None, max_request_cost=0.0, archive_max_bytes=2 * 1024 ** 3,
+                 archive_max_count=None, clients=None, dreams_dir="dreams", draft_scale=0.25, draft_steps=1,
+                 save_in_background=True, dream_template="{adjectives} {subjects} {actions} {objects} {places}",
+                 dream_slot_weights=None, quota_limits=None):
+        """
+        timeout: Seconds after which a client is given up on and the next one is tried
+        hedge_delay: Seconds to wait for a client before sending the same prompt to the next client as well.
+            None disables hedging (clients are tried one after another), 0 races clients right away.
+        max_request_cost: Cap (in USD) on the total cost of clients raced for a single prompt, for a 1024x1024 image
+            like the clients' `cost_per_image`; it scales with the pixel count of the image like their costs do.
+            Falling back to the next client after a failure or timeout is not limited by it.
+        archive_max_bytes, archive_max_count: Retention of the dream archive in `dreams_dir`; the least recently used
+            dreams are deleted beyond either
+        clients: Async inference clients in priority order, instead of the ones in `_client_priority_order`
+        dreams_dir: Where the images and the bookkeeping of the archive and provider stats are kept
+        draft_scale, draft_steps: Size (relative to the final image) and inference steps of the quick drafts of
+            `visualize_progressive`
+        save_in_background: Return the path of an image before it is saved, which happens on a background thread. It
+            can be shown in the meantime, from memory, by the Displayer.
+        dream_template: How `imagine` puts a dream together; every slot in braces takes a phrase from prompts/<slot>.txt
+        dream_slot_weights: Slot -> probability that `imagine` fills it in at all, for slots that are optional
+        quota_limits: Client name -> {"requests_per_minute": ..., "monthly_budget": ...}, for accounts whose quotas
+            differ from the defaults of the client classes
+        """
+        self._clients = list(clients) if clients is not None else self._initialize_clients()
         if not self._clients:
             raise Exception("No clients could be initialized")
-        self._dream_prompts = self._read_dream_prompts()
+        self._prompt_sampler = PromptSampler(self._read_dream_prompts(),
+                                             template=dream_template,
+                                             weights=dream_slot_weights,
+                                             state_path=os.path.join(dreams_dir, ".prompt_sampler.json"))
+        self._timeout = timeout
+        self._hedge_delay = hedge_delay
+        self._max_request_cost = max_request_cost
+        self._dreams_dir = dreams_dir
+        self._draft_scale = draft_scale
+        self._draft_steps = draft_steps
+        self._save_in_background = save_in_background
+        self._archive = DreamArchive(dreams_dir, max_bytes=archive_max_bytes, max_count=archive_max_count)
+        self._cache = DreamCache(self._archive)
+        # Key of the dream on screen, see `mark_shown`
+        self._on_screen = None
+        self._on_screen_lock = threading.Lock()
+        self._provider_stats = ProviderStats(state_path=os.path.join(dreams_dir, ".provider_stats.json"),
+                                             failure_penalty=timeout)
+        self._provider_quotas = ProviderQuotas(state_path=os.path.join(dreams_dir, ".provider_quotas.json"),
+                                               limits=quota_limits)
+        # The clients are async so that timed out and outraced requests can really be cancelled. They all run on this
+        # event loop, while `visualize` stays a blocking call for the rest of the app.
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._run_event_loop, daemon=True)
+        self._loop_thread.start()
+        # Runs the final image of `visualize_progressive` while the draft is being generated
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="visualize")
 
     def _initialize_clients(self):
+        """Clients are only constructed when first used (or warmed up); here it's just checked that they have a key"""
         clients = list()
         for client_class in self._client_priority_order:
-            try:
-                client = client_class()
-                clients.append(client)
-            except Exception as e:
-                logger.error(f"Error initializing {client_class}: {e}")
+            if not os.path.isfile(client_class.default_api_key_path()):
+                logger.error(f"Error initializing {client_class}: {client_class.default_api_key_path()} not found")
                 continue
+            clients.append(LazyClient(client_class))
         return clients
 
+    def warm_up(self):
+        """Constructs the clients ahead of their first use, e.g. in the background once the app is up"""
+        for client in self._clients:
+            if not isinstance(client, LazyClient):
+                continue
+            try:
+                client.get()
+            except Exception as e:
+                logger.error(f"Error initializing {client}: {e}")
+
     @staticmethod
     def _read_dream_prompts():
         files = glob.glob(os.path.join("prompts", "**", "*.txt"), recursive=True)
@@ -43,40 +146,326 @@ class Dreamer:
                 dream_prompts[os.path.splitext(os.path.basename(file))[0]] = lines
         return dream_prompts
 
-    def _call_api_blocking(self, client, text, height, width):
-        return client.text_to_image(text, height=height, width=width)
+    def _run_event_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
 
-    def visualize(self, text, save_as=None, height=1024, width=1024):
-        image = None
-        for client in self._clients:
-            logger.info(f"Pinging client: {client}\nPrompt: {text}")
-            try:
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future = executor.submit(self._call_api_blocking, client, text, height, width)
-                    image = future.result(timeout=60)
-            except Exception as e:
-                logger.error(f"{e} raised while trying to use {client}; will try next client")
-                continue
-            break
+    async def _call_api(self, client, text, height, width, steps, record_stats=True):
+        """Calls the client and records how it went. Cancellation (timed out or outraced) is left to the caller.
+        record_stats: Whether the outcome counts towards the client's ProviderStats and circuit breaker"""
+        t0 = time.monotonic()
+        try:
+            image = await client.text_to_image(text, height=height, width=width, steps=steps)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            latency = time.monotonic() - t0
+            backoff = rate_limit_backoff(e)
+            if backoff is not None:
+                # Says nothing about the health of the client, so its circuit is left alone
+                self._provider_quotas.record_rate_limited(client, backoff)
+                self._provider_stats.release(client)
+                metrics.increment("provider_rate_limited", provider=client)
+            elif record_stats:
+                self._provider_stats.record_failure(client, latency)
+                metrics.increment("provider_failures", provider=client)
+            else:
+                self._provider_stats.release(client)
+            metrics.observe("provider_request", latency, provider=client, outcome="failure")
+            raise
+        latency = time.monotonic() - t0
+        self._provider_quotas.record_success(client, height, width)
+        if record_stats:
+            self._provider_stats.record_success(client, latency)
+        else:
+            self._provider_stats.release(client)
+        metrics.observe("provider_request", latency, provider=client, outcome="success")
+        return image
+
+    async def _race_clients(self, text, height, width, steps, record_stats=True):
+        """Returns the first image delivered by any of the clients and the client, or (None, None) if all of them fail.
+        With hedging enabled, the next client is pinged as well whenever `hedge_delay` passes without an image, as long
+        as the clients raced so far stay within `max_request_cost`. Losing and timed out calls are cancelled, which
+        aborts their requests in flight.
+        Clients are tried best ranked first, skipping those whose circuit breaker is open or that are out of quota. If
+        all of them are only out of requests for the minute, the request waits for the first one that has some again.
+        """
+        # Clients with quota left go first, so that no request is sent to one that can't take it while others can
+        remaining = sorted(self._provider_stats.ranked(self._clients),
+                           key=lambda client: not self._provider_quotas.has_capacity(client, height, width))
+        wait_time = self._provider_quotas.wait_time(remaining, height, width)
+        if wait_time > self._timeout:
+            logger.error(f"All clients are out of quota for the next {wait_time}s")
+            metrics.increment("quota_exhausted")
+            return None, None
+        if wait_time > 0:
+            logger.info(f"All clients are at their rate limits; waiting {wait_time:.1f}s")
+            metrics.observe("quota_wait", wait_time)
+            await asyncio.sleep(wait_time)
+        pending = dict()  # task -> (client, deadline)
+        request_cost = 0.0
+        max_request_cost = self._max_request_cost * size_factor(height, width)
+
+        def refund_unless_delivered(client):
+            def callback(task):
+                # Failed, timed out or outraced (possibly before it even started): its cost was never incurred
+                if task.cancelled() or task.exception() is not None:
+                    self._provider_quotas.refund(client, height, width)
+            return callback
+
+        def launch_next(hedge):
+            nonlocal request_cost
+            for client in remaining:
+                if hedge and request_cost + image_cost(client, height, width) > max_request_cost:
+                    continue
+                remaining.remove(client)
+                if not self._provider_quotas.acquire(client, height, width):
+                    logger.info(f"Skipping {client} as it is out of quota")
+                    metrics.increment("provider_quota_skips", provider=client)
+                    return launch_next(hedge)
+                if not self._provider_stats.allow_request(client):
+                    logger.info(f"Skipping {client} as its circuit is open")
+                    self._provider_quotas.release(client, height, width)
+                    return launch_next(hedge)
+                logger.info(f"Pinging client: {client}\nPrompt: {text}")
+                request_cost += image_cost(client, height, width)
+                task = asyncio.create_task(self._call_api(client, text, height, width, steps, record_stats))
+                task.add_done_callback(refund_unless_delivered(client))
+                pending[task] = (client, time.monotonic() + self._timeout)
+                return True
+            return False
+
+        launch_next(hedge=False)
+        next_hedge = time.monotonic() + self._hedge_delay if self._hedge_delay is not None else float("inf")
+
+        try:
+            while pending:
+                wake_at = min(next_hedge, *(deadline for _, deadline in pending.values()))
+                done, _ = await asyncio.wait(pending, timeout=max(0.0, wake_at - time.monotonic()),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    client, _ = pending.pop(task)
+                    try:
+                        image = task.result()
+                    except Exception as e:
+                        logger.error(f"{e} raised while trying to use {client}; will try next client")
+                        continue
+                    if image:
+                        logger.info(f"Image received from {client}")
+                        return image, client
+
+                now = time.monotonic()
+                for task, (client, deadline) in list(pending.items()):
+                    if now >= deadline:
+                        logger.error(f"{client} timed out after {self._timeout}s; will try next client")
+                        del pending[task]
+                        task.cancel()
+                        if record_stats:
+                            self._provider_stats.record_failure(client, self._timeout)
+                        else:
+                            self._provider_stats.release(client)
+                        metrics.increment("provider_failures", provider=client)
+                        metrics.increment("provider_timeouts", provider=client)
+
+                if not pending:
+                    launch_next(hedge=False)
+                elif now >= next_hedge:
+                    if launch_next(hedge=True):
+                        next_hedge = now + self._hedge_delay
+                    else:
+                        # Remaining clients are too expensive to race; they are only used as fallback from now on
+                        logger.info(f"Not hedging further as it would exceed the cost cap of {max_request_cost}")
+                        next_hedge = float("inf")
+        finally:
+            for task, (client, _) in pending.items():
+                task.cancel()
+                # Being outraced says nothing about a client, but a half-open probe has to be given back
+                self._provider_stats.release(client)
+
+        return None, None
+
+    def visualize(self, text, save_as=None, height=1024, width=1024, steps=4, weight=1.0, shown=True):
+        """Returns the path of the image for `text`. Unless `save_as` is given, a previously rendered image of the same
+        prompt is reused from the cache without pinging any client, and a new one is added to the archive.
+        weight: How often the dream comes back among the past dreams, relative to the others
+        shown: False for a dream generated ahead of being shown (prefetched), which only becomes a past dream once it
+            has been on screen; see `mark_shown`"""
+        cache_key = None
+        if not save_as:
+            cache_key = DreamCache.make_key(text, width, height, self._model, steps)
+            cached = self._cache.get(cache_key)
+            if cached:
+                logger.info(f"Cache hit for prompt: {text}\nImage: {cached}\nCache stats: {self._cache.stats()}")
+                return cached
+            save_as = self._cache.path_for(cache_key)
+
+        with metrics.span("generation"):
+            image, client, latency = self._start_generation(text, height, width, steps).result()
 
         if not image:
             logger.error(f"Image could not be generated")
             return
+        return self._store(text, image, client, latency, save_as, cache_key, height, width, steps, weight, shown)
 
-        if not save_as:
-            save_as = os.path.join("dreams", f"{text}.jpeg")
+    async def _generate(self, text, height, width, steps, record_stats=True):
+        t0 = time.monotonic()
+        image, client = await self._race_clients(text, height, width, steps, record_stats)
+        return image, client, time.monotonic() - t0
+
+    def _start_generation(self, text, height, width, steps, record_stats=True):
+        """Returns a future of (image, client, seconds taken). Cancelling it cancels the requests in flight."""
+        return asyncio.run_coroutine_threadsafe(self._generate(text, height, width, steps, record_stats), self._loop)
+
+    def _store(self, text, image, client, latency, save_as, cache_key, height, width, steps, weight, shown=True):
+        """Saves a generated image as `save_as`, and archives it if it has a `cache_key`. Returns the path."""
+
+        def add_to_cache(path):
+            if cache_key:
+                self._cache.put(cache_key, path, text, provider=client, model=self._model, width=width, height=height,
+                                steps=steps, latency=latency, weight=weight, shown=shown)
 
-        save_as = save_as[:-5][:250] + ".jpeg"
-        os.makedirs(os.path.dirname(save_as), exist_ok=True)
-        image.save(save_as)
+        if self._save_in_background:
+            if cache_key:
+                # Asking for the same dream again before it's written is a hit, not a second generation
+                self._cache.add_pending(cache_key, save_as)
+            image_writer.submit(save_as, image, on_written=add_to_cache)
+            return save_as
+
+        os.makedirs(os.path.dirname(save_as) or ".", exist_ok=True)
+        with metrics.span("image_save"):
+            image.save(save_as)
         logger.info(f"Image saved as {save_as}")
+        add_to_cache(save_as)
         return save_as
 
+    def speculate(self, text, height=1024, width=1024, steps=4):
+        """Starts generating the image for a prompt that may still change. Returns a Speculation to commit or cancel
+        once the prompt is final, or None if the image is cached already (and so needs no head start)."""
+        if self._cache.contains(DreamCache.make_key(text, width, height, self._model, steps)):
+            return None
+        logger.info(f"Speculatively generating: {text}")
+        return Speculation(self, text, height, width, steps)
+
+    def _draft_size(self, height, width):
+        # Providers want multiples of 16 and don't go below 256
+        return tuple(max(256, int(side * self._draft_scale / 16) * 16) for side in (height, width))
+
+    def visualize_progressive(self, text, on_draft, height=1024, width=1024, steps=4, weight=1.0, parallel=True):
+        """Like `visualize`, but a quick low-resolution draft is generated first and handed to `on_draft(path)`, to be
+        shown until the final image is there. The draft is skipped if the final image is cached or arrives first.
+        parallel: Request the final image along with the draft, rather than after it. Faster, but both are paid for.
+        Returns the path of the final image, or of the draft if only the draft could be generated; it is then archived
+        like any other dream.
+        """
+        if self._cache.contains(DreamCache.make_key(text, width, height, self._model, steps)):
+            return self.visualize(text, height=height, width=width, steps=steps, weight=weight)
+
+        t0 = time.monotonic()
+        draft_height, draft_width = self._draft_size(height, width)
+        # A low-resolution draft says little about how a provider does with full size images, so it isn't counted
+        draft_future = self._start_generation(text, draft_height, draft_width, self._draft_steps, record_stats=False)
+        final_future = self._executor.submit(self.visualize, text, height=height, width=width, steps=steps,
+                                             weight=weight) if parallel else None
+
+        draft_img = dream_img = None
+        draft_latency = None
+        pending = {future for future in (draft_future, final_future) if future}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            if final_future in done:
+                dream_img = final_future.result()
+                if dream_img:
+                    # Whatever the draft was going to be, it is of no use any more
+                    draft_future.cancel()
+                    break
+            if draft_future in done:
+                draft_img = self._store_draft(text, draft_future, draft_height, draft_width)
+                draft_latency = time.monotonic() - t0
+                if draft_img and not (final_future and final_future.done()):
+                    metrics.observe("draft_latency", draft_latency)
+                    on_draft(draft_img)
+
+        if not final_future:
+            dream_img = self.visualize(text, height=height, width=width, steps=steps, weight=weight)
+        final_latency = time.monotonic() - t0
+        metrics.observe("final_latency", final_latency)
+        draft_after = f"{draft_latency:.2f}s" if draft_latency is not None else "never"
+        logger.info(f"Progressive dream: draft after {draft_after}, final after {final_latency:.2f}s")
+
+        if draft_img:
+            image_writer.remove(draft_img)
+            if not dream_img:
+                # The draft is all there is, so it becomes the dream, and is subject to retention like the others
+                return self._store_draft(text, draft_future, draft_height, draft_width, weight, archive=True)
+        return dream_img
+
+    def _store_draft(self, text, draft_future, height, width, weight=1.0, archive=False):
+        """Saves the draft once it's generated; returns its path, or None if there is none
+        archive: Archive it under its own key, as a dream of its own, rather than as a hidden file"""
+        try:
+            image, client, latency = draft_future.result()
+        except concurrent.futures.CancelledError:
+            return None
+        if not image:
+            return None
+        draft_key = DreamCache.make_key(text, width, height, self._model, self._draft_steps)
+        if archive:
+            return self._store(text, image, client, latency, self._cache.path_for(draft_key), draft_key, height, width,
+                               self._draft_steps, weight)
+        # Drafts are hidden files, so they are neither cached nor picked as past dreams
+        return self._store(text, image, client, latency, os.path.join(self._dreams_dir, f".draft-{draft_key}.jpeg"),
+                           None, height, width, self._draft_steps, 1.0)
+
+    def get_dreams_dir(self):
+        return self._dreams_dir
+
+    def get_cache_stats(self):
+        return self._cache.stats()
+
+    def get_random_dream(self):
+        """Path of a past dream, picked at random in proportion to the weights, or None if there is none"""
+        return self._archive.sample(weighted=True)
+
+    def mark_shown(self, path):
+        """To be called when a dream goes up on screen, new or past. It becomes a past dream if it was generated with
+        `shown=False`, it is kept from eviction for as long as it is up, i.e. until the next one is marked, and it is
+        evicted last after that."""
+        key = os.path.splitext(os.path.basename(path))[0]
+        with self._on_screen_lock:
+            previous, self._on_screen = self._on_screen, key
+        if previous and previous != key:
+            self._archive.unpin(previous)
+        self._archive.pin(key)
+        self._archive.mark_shown(key)
+
+    def get_archive_stats(self):
+        return self._archive.stats()
+
+    def get_provider_stats(self):
+        return self._provider_stats.summary()
+
+    def get_provider_quotas(self):
+        return self._provider_quotas.summary()
+
+    def shutdown(self):
+        if not self._loop.is_running():
+            return
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        image_writer.flush()
+        try:
+            asyncio.run_coroutine_threadsafe(close_shared_http_client(), self._loop).result(timeout=5)
+        except Exception as e:
+            logger.error(f"Error closing connection pool: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join(timeout=5)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
     def imagine(self):
-        """This generates prompt for a new dream using combination of random subject-activity"""
-        dream = " ".join([random.choice(self._dream_prompts["adjectives"]),
-                          random.choice(self._dream_prompts["subjects"]),
-                          random.choice(self._dream_prompts["actions"]),
-                          random.choice(self._dream_prompts["objects"]),
-                          random.choice(self._dream_prompts["places"])])
-        return dream
+        """This generates prompt for a new dream using combination of random subject-activity.
+        No combination comes up twice until all of them have."""
+        return self._prompt_sampler.sample()
@@ -0,0 +1,83 @@
+import logging
+import os
+import queue
+import threading
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ImageWriter:
+    """Saves images to disk on a background thread, so that saving is not on the way to the screen. Until an image has
+    been written it is served from memory by `get`, and can be shown right away."""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = dict()  # path -> image not written yet
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, path, image, on_written=None):
+        """
+        image: Anything with a `save(path)`, e.g. an EncodedImage or a PIL image
+        on_written: Called with `path` once the image is on disk
+        """
+        with self._lock:
+            self._pending[path] = image
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="image-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((path, image, on_written))
+
+    def remove(self, path):
+        """Deletes `path` once whatever was submitted before has been written"""
+        with self._lock:
+            self._pending.pop(path, None)
+        self._queue.put((path, None, None))
+
+    def get(self, path):
+        """Returns the image if it is still waiting to be written, None otherwise"""
+        with self._lock:
+            return self._pending.get(str(path))
+
+    def exists(self, path):
+        return self.get(path) is not None or os.path.isfile(path)
+
+    def flush(self):
+        """Blocks until everything submitted has been written"""
+        with self._lock:
+            if self._thread is None:
+                return
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            path, image, on_written = self._queue.get()
+            try:
+                if image is None:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                    continue
+
+                directory, file_name = os.path.split(path)
+                os.makedirs(directory or ".", exist_ok=True)
+                # Written under a hidden name first, so that nobody finds a half-written image
+                tmp_path = os.path.join(directory, f".tmp-{file_name}")
+                with metrics.span("image_save"):
+                    image.save(tmp_path)
+                os.replace(tmp_path, path)
+                logger.info(f"Image saved as {path}")
+                if on_written:
+                    on_written(path)
+            except Exception as e:
+                logger.error(f"Error writing {path}: {e}")
+            finally:
+                with self._lock:
+                    if image is not None and self._pending.get(path) is image:
+                        del self._pending[path]
+                self._queue.task_done()
+
+
+# Shared by the whole app
+image_writer = ImageWriter()
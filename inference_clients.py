@@ -1,19 +1,95 @@
+import asyncio
 import base64
+import os
+import threading
 from io import BytesIO
 
-from PIL import Image
-from huggingface_hub import InferenceClient
-from openai import OpenAI
-from together import Together
+# The SDKs are imported by the clients that need them, when they are constructed, as importing all of them adds
+# seconds to the startup on a Raspberry Pi
+
+# Connection pool shared by the clients that are built on httpx (the OpenAI SDK ones: Together and Nebius), so that
+# connections are kept alive and reused across requests and providers. It is bound to the event loop it is first used
+# on. huggingface_hub's async client (before 1.0, as pinned in requirements.txt) runs on aiohttp, and keeps
+# connections of its own.
+_shared_http_client = None
+
+
+def get_shared_http_client():
+    import httpx
+
+    global _shared_http_client
+    if _shared_http_client is None or _shared_http_client.is_closed:
+        _shared_http_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+                                                timeout=httpx.Timeout(120, connect=10))
+    return _shared_http_client
+
+
+async def close_shared_http_client():
+    if _shared_http_client is not None and not _shared_http_client.is_closed:
+        await _shared_http_client.aclose()
+
+
+class EncodedImage:
+    """Image as the provider sent it. Decoding is left until `image` is first used, and `save` writes the original bytes
+    as they are if the file extension matches their format, instead of decoding and re-encoding them."""
+    _extension_formats = {".jpeg": "JPEG", ".jpg": "JPEG", ".png": "PNG", ".webp": "WEBP"}
+
+    def __init__(self, data):
+        self.data = data
+        self._image = None
+        self._lock = threading.Lock()
+
+    @property
+    def image(self):
+        """The decoded PIL image"""
+        from PIL import Image
+
+        with self._lock:
+            if self._image is None:
+                image = Image.open(BytesIO(self.data))
+                image.load()
+                self._image = image
+            return self._image
+
+    @property
+    def format(self):
+        from PIL import Image
+
+        with self._lock:
+            if self._image is not None:
+                return self._image.format
+        # Only reads the header
+        return Image.open(BytesIO(self.data)).format
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def save(self, path):
+        if self._extension_formats.get(os.path.splitext(path)[1].lower()) == self.format:
+            with open(path, "wb") as f:
+                f.write(self.data)
+        else:
+            self.image.save(path)
+
+
+def decode_b64_image(b64_json):
+    return EncodedImage(base64.b64decode(b64_json))
 
 
 class InferenceClientBase:
+    # Approximate USD per 1024x1024 FLUX-schnell image, as of 2025/03/07
+    cost_per_image = 0.0
+    # Quotas of the account (see ProviderQuotas); None is unlimited. Depend on the plan, so they can be overridden.
+    requests_per_minute = None
+    monthly_budget = None
+
     def __init__(self, api_key=None):
         if api_key is None:
             api_key = self.read_token()
         self._api_key = api_key
 
-    def text_to_image(self, text, height=1024, width=1024):
+    def text_to_image(self, text, height=1024, width=1024, steps=4):
         raise NotImplementedError
 
     def read_token(self):
@@ -25,17 +101,34 @@ class InferenceClientBase:
     def default_api_key_path(cls):
         raise NotImplementedError
 
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class AsyncInferenceClientBase(InferenceClientBase):
+    """Same as InferenceClientBase, but `text_to_image` is a coroutine. Cancelling it aborts the HTTP request in flight,
+    which is what makes timeouts actually bound the latency."""
+
+    async def text_to_image(self, text, height=1024, width=1024, steps=4):
+        raise NotImplementedError
+
+
+class AsyncHFInferenceClient(AsyncInferenceClientBase):
+    cost_per_image = 0.0024
+    # Free credits
+    monthly_budget = 0.10
 
-class HFInferenceClient(InferenceClientBase):
     def __init__(self, provider="hf-inference", api_key=None):
         super().__init__(api_key=api_key)
-        self._client = InferenceClient(provider=provider, api_key=self._api_key)
-
-    def text_to_image(self, text, model="black-forest-labs/FLUX.1-schnell", height=1024, width=1024):
-        image = self._client.text_to_image(text,
-                                           model=model,
-                                           height=height,
-                                           width=width)
+        from huggingface_hub import AsyncInferenceClient
+        self._client = AsyncInferenceClient(provider=provider, api_key=self._api_key)
+
+    async def text_to_image(self, text, model="black-forest-labs/FLUX.1-schnell", height=1024, width=1024, steps=4):
+        image = await self._client.text_to_image(text,
+                                                 model=model,
+                                                 height=height,
+                                                 width=width,
+                                                 num_inference_steps=steps)
         return image
 
     @classmethod
@@ -43,48 +136,93 @@ class HFInferenceClient(InferenceClientBase):
         return ".hf_token.txt"
 
 
-class TogetherClient(InferenceClientBase):
+class AsyncTogetherClient(AsyncInferenceClientBase):
+    """Uses Together's OpenAI compatible endpoint, so that it can share the connection pool"""
+    cost_per_image = 0.0
+
     def __init__(self, api_key=None):
         super().__init__(api_key=api_key)
-        self._client = Together(api_key=self._api_key)
-
-    def text_to_image(self, text, model="black-forest-labs/FLUX.1-schnell-free", height=1024, width=1024):
-        response = self._client.images.generate(prompt=text,
-                                                model=model,
-                                                height=height,
-                                                width=width,
-                                                response_format="b64_json",
-                                                steps=4)
-        data = base64.b64decode(response.data[0].b64_json)
-        image = Image.open(BytesIO(data))
-        return image
+        from openai import AsyncOpenAI
+        self._client = AsyncOpenAI(base_url="https://api.together.xyz/v1",
+                                   api_key=self._api_key,
+                                   http_client=get_shared_http_client())
+
+    async def text_to_image(self, text, model="black-forest-labs/FLUX.1-schnell-free", height=1024, width=1024,
+                            steps=4):
+        response = await self._client.images.generate(
+            model=model,
+            response_format="b64_json",
+            extra_body={
+                "width": width,
+                "height": height,
+                "steps": steps,
+                # Same format as the dreams are saved in, so that they are saved without re-encoding
+                "output_format": "jpeg",
+            },
+            prompt=text
+        )
+        return decode_b64_image(response.data[0].b64_json)
 
     @classmethod
     def default_api_key_path(cls):
         return ".together-ai-key.txt"
 
 
-class NebiusClient(InferenceClientBase):
+class AsyncNebiusClient(AsyncInferenceClientBase):
+    cost_per_image = 0.0013
+
     def __init__(self, api_key=None):
         super().__init__(api_key=api_key)
-        self._client = OpenAI(base_url="https://api.studio.nebius.com/v1/",
-                              api_key=self._api_key)
+        from openai import AsyncOpenAI
+        self._client = AsyncOpenAI(base_url="https://api.studio.nebius.com/v1/",
+                                   api_key=self._api_key,
+                                   http_client=get_shared_http_client())
 
-    def text_to_image(self, text, model="black-forest-labs/flux-schnell", height=1024, width=1024):
-        response = self._client.images.generate(
+    async def text_to_image(self, text, model="black-forest-labs/flux-schnell", height=1024, width=1024, steps=4):
+        response = await self._client.images.generate(
             model=model,
             response_format="b64_json",
             extra_body={
                 "width": width,
                 "height": height,
-                "num_inference_steps": 4,
+                "num_inference_steps": steps,
+                # Same format as the dreams are saved in, so that they are saved without re-encoding
+                "response_extension": "jpg",
             },
             prompt=text
         )
-        data = base64.b64decode(response.data[0].b64_json)
-        image = Image.open(BytesIO(data))
-        return image
+        return decode_b64_image(response.data[0].b64_json)
 
     @classmethod
     def default_api_key_path(cls):
         return ".nebius-key.txt"
+
+
+class LazyClient:
+    """Stands in for an inference client until it is first used (or warmed up), so that neither the client nor its SDK
+    has to be loaded at startup"""
+
+    def __init__(self, client_class, **kwargs):
+        self._client_class = client_class
+        self._kwargs = kwargs
+        self._client = None
+        self._lock = threading.Lock()
+        self.cost_per_image = client_class.cost_per_image
+        self.requests_per_minute = client_class.requests_per_minute
+        self.monthly_budget = client_class.monthly_budget
+
+    def get(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self._client_class(**self._kwargs)
+            return self._client
+
+    async def text_to_image(self, text, height=1024, width=1024, steps=4):
+        client = self._client
+        if client is None:
+            # Importing the SDK takes seconds, which mustn't hold up the other requests on the event loop
+            client = await asyncio.to_thread(self.get)
+        return await client.text_to_image(text, height=height, width=width, steps=steps)
+
+    def __str__(self):
+        return self._client_class.__name__
@@ -0,0 +1,26 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def load_state(path, what):
+    """Returns the JSON in `path`, or None if there is none yet or it can't be read (which is logged, as `what`)"""
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not read {what} {path}: {e}")
+        return None
+
+
+def save_state(path, state, indent=None):
+    """Writes `state` to `path` as JSON, atomically, so that a crash mid-write doesn't lose what was there"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=indent)
+    os.replace(tmp_path, path)
@@ -1,18 +1,21 @@
+import collections
+import hashlib
+import json
 import logging
 import os
 import platform
 import queue
+import tempfile
 import time
 from contextlib import contextmanager
 from ctypes import CFUNCTYPE, c_char_p, c_int, cdll
 
 import numpy as np
-import pvporcupine
-import pyaudio
-from google.cloud import speech
-from openwakeword.model import Model
-from pvrecorder import PvRecorder
-import openwakeword
+
+# pvporcupine, pvrecorder, pyaudio and openwakeword (which pulls in onnxruntime) are imported where they are used, so
+# that importing this module doesn't hold up the startup
+from metrics import metrics
+from speech_backends import GoogleSpeechBackend, TranscriptLatency, create_speech_backend
 
 
 # Used in the context manager to disable ALSA errors
@@ -28,10 +31,12 @@ logger = logging.getLogger(__name__)
 class MicrophoneStream:
     """Opens a recording stream as a generator yielding the audio chunks."""
 
-    def __init__(self: object, rate: int = 16000, chunk: int = 1600) -> None:
-        """The audio -- and generator -- is guaranteed to be on the main thread."""
+    def __init__(self: object, rate: int = 16000, chunk: int = 1600, endpointer: object = None) -> None:
+        """The audio -- and generator -- is guaranteed to be on the main thread.
+        An Endpointer, if given, trims the silence and ends the stream as soon as the speaker stops."""
         self._rate = rate
         self._chunk = chunk
+        self._endpointer = endpointer
 
         # Create a thread-safe buffer of audio data
         self._buff = queue.Queue()
@@ -56,6 +61,9 @@ class MicrophoneStream:
 
     def __enter__(self: object) -> object:
         # Disable ALSA errors (Linux only)
+        import pyaudio
+        self._pyaudio = pyaudio
+
         with self.noalsaerr():
             self._audio_interface = pyaudio.PyAudio()
 
@@ -111,7 +119,7 @@ class MicrophoneStream:
             The audio data as a bytes object
         """
         self._buff.put(in_data)
-        return None, pyaudio.paContinue
+        return None, self._pyaudio.paContinue
 
     def generator(self: object) -> object:
         """Generates audio chunks from the stream of audio data in chunks.
@@ -122,6 +130,11 @@ class MicrophoneStream:
         Returns:
             A generator that outputs audio chunks.
         """
+        if self._endpointer:
+            return self._endpointer.filter(self._chunks())
+        return self._chunks()
+
+    def _chunks(self: object) -> object:
         while not self.closed:
             # Use a blocking get() to ensure there's at least one chunk of
             # data, and stop iteration if the chunk is None, indicating the
@@ -144,15 +157,542 @@ class MicrophoneStream:
             yield b"".join(data)
 
 
+class WakeWordDetector:
+    """A wake word engine fed by the AudioBus. It consumes `frame_length` samples at a time."""
+    frame_length = 512
+
+    def __init__(self, name):
+        self.name = name
+
+    def reset(self):
+        pass
+
+    def process(self, pcm):
+        """Returns the detected wake word, or None"""
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.name
+
+
+class PorcupineDetector(WakeWordDetector):
+    def __init__(self, porcupine, keywords):
+        super().__init__("porcupine")
+        self._porcupine = porcupine
+        self._keywords = keywords
+        self.frame_length = porcupine.frame_length
+
+    def process(self, pcm):
+        keyword_index = self._porcupine.process(pcm)
+        if keyword_index >= 0:
+            return self._keywords[keyword_index]
+        return None
+
+
+class EnergyGate:
+    """Cheap voice activity check in front of a wake word model, so that the model doesn't run in a quiet room.
+    A frame passes when its RMS is `ratio` times above the noise floor (and above `min_rms`), and so do the frames of
+    the following `hangover` seconds, as wake word models decide only after the phrase has ended. When the gate opens,
+    the `pre_roll` seconds of audio before are passed as well, so that the model hears the onset of the phrase.
+    The noise floor falls quickly to quieter frames and rises slowly with louder ones, so that speech doesn't lift it
+    but a new steady noise (a fan) closes the gate again after a while."""
+
+    def __init__(self, frame_length=1280, sample_rate=16000, ratio=3.0, min_rms=100, hangover=1.5, pre_roll=0.5,
+                 floor_fall_alpha=0.2, floor_rise_alpha=0.005):
+        self._ratio = ratio
+        self._min_rms = min_rms
+        self._hangover_frames = round(hangover * sample_rate / frame_length)
+        self._pre_roll = collections.deque(maxlen=round(pre_roll * sample_rate / frame_length))
+        self._floor_fall_alpha = floor_fall_alpha
+        self._floor_rise_alpha = floor_rise_alpha
+        self._noise_floor = None
+        self._open_frames = 0  # Frames left until the gate closes
+        self.frames_passed = 0
+        self.frames_skipped = 0
+
+    def reset(self):
+        self._open_frames = 0
+        self._pre_roll.clear()
+
+    @staticmethod
+    def rms(pcm):
+        samples = pcm.astype(np.float32)
+        return float(np.sqrt(np.dot(samples, samples) / max(len(samples), 1)))
+
+    def push(self, frame):
+        """Returns the frames the model should see: none while it's quiet; otherwise `frame`, preceded by the pre-roll
+        if the gate has just opened"""
+        rms = self.rms(frame)
+        if self._noise_floor is None:
+            self._noise_floor = rms
+        loud = rms > max(self._min_rms, self._ratio * self._noise_floor)
+        alpha = self._floor_fall_alpha if rms < self._noise_floor else self._floor_rise_alpha
+        self._noise_floor += alpha * (rms - self._noise_floor)
+
+        if loud:
+            frames = list(self._pre_roll) + [frame]
+            self._pre_roll.clear()
+            self._open_frames = self._hangover_frames
+        elif self._open_frames > 0:
+            frames = [frame]
+            self._open_frames -= 1
+        else:
+            # Frames are reused by the FrameAdapter
+            self._pre_roll.append(frame.copy())
+            self.frames_skipped += 1
+            return []
+        self.frames_passed += len(frames)
+        return frames
+
+
+class Endpointer:
+    """Detects the end of a spoken dream on the device, so that the audio stream to the speech-to-text engine is closed
+    `hangover` seconds after the speaker stops, instead of when the engine notices (Google's end-of-utterance detection
+    alone takes about a second). Silence is trimmed from what is sent: all but `leading_pad` seconds before the speech,
+    and all but `trailing_pad` seconds of every pause; if speech resumes, up to `trailing_pad` seconds before it are
+    sent as well.
+    Speech is told from silence by energy, like the EnergyGate does, in frames of `frame_seconds`."""
+
+    def __init__(self, sample_rate=16000, hangover=0.6, leading_pad=0.3, trailing_pad=0.2, min_speech=0.2,
+                 no_speech_timeout=5.0, frame_seconds=0.02, ratio=3.0, min_rms=100, noise_floor=None,
+                 floor_fall_alpha=0.1, floor_rise_alpha=0.002):
+        """
+        hangover: Seconds of silence after which the speaker is taken to be done
+        min_speech: Seconds of speech needed before the stream may be ended, so that a click doesn't end it
+        no_speech_timeout: Seconds after which the stream is ended if nothing has been said, or nothing since a sound too
+            short to count as speech
+        noise_floor: RMS of the room's background, e.g. from `estimate_noise_floor`; otherwise it is learnt as it goes
+        """
+        self._sample_rate = sample_rate
+        self._hangover = round(hangover * sample_rate)
+        self._trailing_pad = round(trailing_pad * sample_rate)
+        self._min_speech = round(min_speech * sample_rate)
+        self._no_speech_timeout = round(no_speech_timeout * sample_rate)
+        self._frame_length = round(frame_seconds * sample_rate)
+        self._ratio = ratio
+        self._min_rms = min_rms
+        self._noise_floor = noise_floor if noise_floor is not None else min_rms / ratio
+        self._floor_fall_alpha = floor_fall_alpha
+        self._floor_rise_alpha = floor_rise_alpha
+        self._leading = collections.deque(maxlen=max(1, round(leading_pad / frame_seconds)))
+        # Silence beyond the trailing pad, of which the last `trailing_pad` seconds are sent if speech resumes
+        self._held = collections.deque(maxlen=max(1, round(trailing_pad / frame_seconds)))
+        self.ended = False
+        self.speech_detected = False
+        # In samples
+        self._heard = 0
+        self._speech = 0
+        self._since_speech = 0
+        self._sent = 0
+        self._leading_trimmed = 0
+        self._trailing_trimmed = 0
+
+    @staticmethod
+    def estimate_noise_floor(pcm, frame_length=320, percentile=10):
+        """RMS of the quieter frames of `pcm`, e.g. of the audio around the wake phrase"""
+        frames = len(pcm) // frame_length
+        if not frames:
+            return None
+        samples = pcm[:frames * frame_length].astype(np.float32).reshape(frames, frame_length)
+        return float(np.percentile(np.sqrt(np.mean(samples * samples, axis=1)), percentile))
+
+    def _seconds(self, samples):
+        return samples / self._sample_rate
+
+    def _process_frame(self, frame):
+        """Returns the frames to send"""
+        rms = EnergyGate.rms(frame)
+        loud = rms > max(self._min_rms, self._ratio * self._noise_floor)
+        alpha = self._floor_fall_alpha if rms < self._noise_floor else self._floor_rise_alpha
+        self._noise_floor += alpha * (rms - self._noise_floor)
+        self._heard += len(frame)
+
+        if loud:
+            if self.speech_detected:
+                frames = list(self._held) + [frame]
+                self._held.clear()
+            else:
+                self.speech_detected = True
+                frames = list(self._leading) + [frame]
+                self._leading.clear()
+            self._speech += len(frame)
+            self._since_speech = 0
+            return frames
+
+        if not self.speech_detected:
+            if len(self._leading) == self._leading.maxlen:
+                self._leading_trimmed += len(self._leading[0])
+            self._leading.append(frame)
+            if self._heard >= self._no_speech_timeout:
+                logger.info(f"Nothing said for {self._seconds(self._heard):.1f}s; ending the stream")
+                self.ended = True
+            return []
+
+        self._since_speech += len(frame)
+        if self._since_speech <= self._trailing_pad:
+            return [frame]
+        if self._since_speech >= self._hangover and self._speech >= self._min_speech:
+            self._trailing_trimmed += sum(len(held) for held in self._held) + len(frame)
+            self._held.clear()
+            self.ended = True
+            return []
+        if self._since_speech >= self._no_speech_timeout:
+            # Only a click or a cough was heard, not enough to be taken for the end of speech
+            logger.info(f"Nothing said for {self._seconds(self._since_speech):.1f}s; ending the stream")
+            self._trailing_trimmed += sum(len(held) for held in self._held) + len(frame)
+            self._held.clear()
+            self.ended = True
+            return []
+        if len(self._held) == self._held.maxlen:
+            self._trailing_trimmed += len(self._held[0])
+        self._held.append(frame)
+        return []
+
+    def process(self, chunk):
+        """Takes a chunk of LINEAR16 audio and returns what of it should be sent; check `ended` after every chunk"""
+        pcm = np.frombuffer(chunk, dtype=np.int16)
+        frames = list()
+        for offset in range(0, len(pcm), self._frame_length):
+            if self.ended:
+                # Heard after the end, so never sent
+                self._trailing_trimmed += len(pcm) - offset
+                break
+            frames += self._process_frame(pcm[offset:offset + self._frame_length])
+        self._sent += sum(len(frame) for frame in frames)
+        return b"".join(frame.tobytes() for frame in frames)
+
+    def filter(self, chunks):
+        """Yields the audio of `chunks` with the silence trimmed, and stops at the end of the speech"""
+        for chunk in chunks:
+            data = self.process(chunk)
+            if data:
+                yield data
+            if self.ended:
+                logger.info(f"End of speech detected on the device after {self._seconds(self._heard):.2f}s")
+                return
+
+    def stats(self):
+        """Seconds of audio"""
+        return {
+            "heard": self._seconds(self._heard),
+            "sent": self._seconds(self._sent),
+            "leading_trimmed": self._seconds(self._leading_trimmed),
+            "trailing_trimmed": self._seconds(self._trailing_trimmed),
+            # Silence after the last speech, when the stream ended
+            "since_speech": self._seconds(self._since_speech),
+            "trailing_sent": self._seconds(min(self._since_speech, self._trailing_pad)),
+        }
+
+
+class OpenWakeWordDetector(WakeWordDetector):
+    # openWakeWord needs 1280 samples per chunk (80ms at 16kHz)
+    frame_length = 1280
+
+    def __init__(self, model, threshold=0.5, debounce_time=5.0, gate=None):
+        """
+        model: openWakeWord Model. All of its wake words are scored together: the melspectrogram and the embedding,
+            which are most of the work, are computed once per frame for all of them.
+        debounce_time: Detections within this many seconds of the previous one are ignored
+        gate: EnergyGate that decides which frames are worth running the model on; None runs it on every frame
+        """
+        super().__init__("openwakeword")
+        self._model = model
+        self._threshold = threshold
+        self._debounce_time = debounce_time
+        self._gate = gate
+        self._last_detection_time = 0  # For debouncing across calls
+
+    def reset(self):
+        # Reset model state to clear any cached audio from previous detections
+        self._model.reset()
+        if self._gate:
+            self._gate.reset()
+
+    def process(self, pcm):
+        frames = self._gate.push(pcm) if self._gate else [pcm]
+        for frame in frames:
+            wake_word = self._predict(frame)
+            if wake_word:
+                return wake_word
+        return None
+
+    def _predict(self, pcm):
+        prediction = self._model.predict(pcm)
+
+        for wake_word, score in prediction.items():
+            if score > self._threshold:
+                current_time = time.time()
+                time_since_last = current_time - self._last_detection_time
+
+                # Check debounce - ignore if detected recently
+                if time_since_last < self._debounce_time:
+                    logger.info(f"Ignoring duplicate detection (debounce: {time_since_last:.1f}s < {self._debounce_time}s)")
+                    continue
+
+                logger.info(f"Detected '{wake_word}' (confidence: {score:.2f})")
+                self._last_detection_time = current_time
+                return wake_word
+        return None
+
+
+class FrameAdapter:
+    """Re-chunks the AudioBus frames into the frame length of a detector, without reallocating on every frame"""
+
+    def __init__(self, frame_length):
+        self._frame_length = frame_length
+        self._buffer = np.zeros(frame_length, dtype=np.int16)
+        self._filled = 0
+
+    def reset(self):
+        self._filled = 0
+
+    def push(self, pcm):
+        """Yields every full frame completed by `pcm`. A yielded frame is only valid until the next one is yielded."""
+        offset = 0
+        while offset < len(pcm):
+            n = min(self._frame_length - self._filled, len(pcm) - offset)
+            self._buffer[self._filled:self._filled + n] = pcm[offset:offset + n]
+            self._filled += n
+            offset += n
+            if self._filled == self._frame_length:
+                self._filled = 0
+                yield self._buffer
+
+
+class RingBuffer:
+    """Fixed-size int16 ring buffer holding the last `capacity` samples. Writing copies into preallocated memory and
+    never reallocates. Positions are absolute sample counts since the buffer was created."""
+
+    def __init__(self, capacity):
+        self._buffer = np.zeros(capacity, dtype=np.int16)
+        self._capacity = capacity
+        self.total_written = 0
+
+    def write(self, pcm):
+        # Only the tail of a write larger than the buffer survives anyway
+        skipped = max(0, len(pcm) - self._capacity)
+        self.total_written += skipped
+        pcm = pcm[skipped:]
+
+        start = self.total_written % self._capacity
+        first = min(len(pcm), self._capacity - start)
+        self._buffer[start:start + first] = pcm[:first]
+        self._buffer[:len(pcm) - first] = pcm[first:]
+        self.total_written += len(pcm)
+
+    def views_since(self, position):
+        """Returns the samples written since `position` as (at most two) views into the buffer, oldest first.
+        Samples older than the capacity of the buffer are lost."""
+        position = max(position, self.total_written - self._capacity)
+        start = position % self._capacity
+        end = self.total_written % self._capacity
+        if position == self.total_written:
+            return []
+        if start < end:
+            return [self._buffer[start:end]]
+        return [self._buffer[start:], self._buffer[:end]]
+
+
+class AudioBusStream:
+    """Same interface as MicrophoneStream, but reads from the AudioBus that is already running, starting with the audio
+    captured since `start_position` (the pre-roll). So nothing said right after the wake phrase is lost and there's no
+    wait for a microphone to open."""
+
+    def __init__(self, audio_bus, start_position, chunk=1600, endpointer=None):
+        self._audio_bus = audio_bus
+        self._position = start_position
+        self._chunk = chunk
+        self._endpointer = endpointer
+        self.closed = True
+
+    def __enter__(self):
+        self.closed = False
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.closed = True
+
+    def generator(self):
+        if self._endpointer:
+            return self._endpointer.filter(self._chunks())
+        return self._chunks()
+
+    def _chunks(self):
+        ring = self._audio_bus.ring
+        while not self.closed:
+            while ring.total_written - self._position < self._chunk:
+                if not self._audio_bus.is_recording:
+                    return
+                self._audio_bus.read()
+
+            data = b"".join(view.tobytes() for view in ring.views_since(self._position))
+            self._position = ring.total_written
+            yield data
+
+
+class AudioBus:
+    """One long-lived capture stream whose frames are fanned out to several wake word detectors in the same pass.
+    The first detector to fire wins."""
+
+    def __init__(self, detectors, frame_length=512, sample_rate=16000, ring_seconds=3, recorder=None):
+        """
+        ring_seconds: How much of the latest audio is kept around, for the pre-roll of the dream
+        recorder: Source of the audio with PvRecorder's interface; by default the microphone
+        """
+        self._detectors = detectors
+        self._adapters = [FrameAdapter(detector.frame_length) for detector in detectors]
+        self._sample_rate = sample_rate
+        if recorder is None:
+            from pvrecorder import PvRecorder
+            recorder = PvRecorder(frame_length=frame_length)
+        self._recorder = recorder
+        self.ring = RingBuffer(ring_seconds * sample_rate)
+        # Position in the ring right after the last wake word
+        self.wake_position = 0
+        # Per detector: number of detections and the latency of the last one, i.e. the time from the end of the audio
+        # chunk that triggered it (buffering included) to the decision
+        self.detection_stats = {detector.name: {"detections": 0, "last_latency": None} for detector in detectors}
+
+    @property
+    def is_recording(self):
+        return self._recorder.is_recording
+
+    def read(self):
+        pcm = np.asarray(self._recorder.read(), dtype=np.int16)
+        self.ring.write(pcm)
+        return pcm
+
+    def listen(self):
+        """Blocks until one of the detectors fires and returns (detector, wake word), or (None, None) if stopped"""
+        for detector, adapter in zip(self._detectors, self._adapters):
+            detector.reset()
+            adapter.reset()
+
+        if not self._recorder.is_recording:
+            self._recorder.start()
+
+        while self._recorder.is_recording:
+            pcm = self.read()
+            read_at = time.monotonic()
+            for detector, adapter in zip(self._detectors, self._adapters):
+                for frame in adapter.push(pcm):
+                    wake_word = detector.process(frame)
+                    if wake_word:
+                        latency = time.monotonic() - read_at
+                        stats = self.detection_stats[detector.name]
+                        stats["detections"] += 1
+                        stats["last_latency"] = latency
+                        metrics.observe("wake_detection", latency, detector=detector)
+                        logger.info(f"{detector} detected '{wake_word}' {latency * 1000:.1f}ms after the audio was read")
+                        self.wake_position = self.ring.total_written
+                        return detector, wake_word
+        return None, None
+
+    def stop(self):
+        if self._recorder.is_recording:
+            self._recorder.stop()
+
+    def delete(self):
+        self.stop()
+        self._recorder.delete()
+
+
 class Listener:
     _wake_keywords = ['picovoice', 'bumblebee']
+    # Loaded into a single openWakeWord model, so that adding one costs only its small classifier
+    _oww_wake_words = ["hey_jarvis"]
 
-    def __init__(self):
+    def __init__(self, stt_backend="google", stt_backend_kwargs=None, audio_bus=None, speech_backend=None,
+                 local_endpointing=True, endpointer_kwargs=None, backend_endpoint_delay=1.0):
+        """
+        stt_backend: Speech-to-text engine for the dream, "google" (cloud) or "vosk" (on device)
+        stt_backend_kwargs: Passed to the speech-to-text engine, e.g. {"model_path": ...} for vosk
+        audio_bus: AudioBus with its own wake word detectors, instead of Porcupine and openWakeWord on the microphone
+        speech_backend: SpeechBackend instance, overrides `stt_backend`
+        local_endpointing: End the dream's audio stream on the device once the speaker stops (see Endpointer)
+        endpointer_kwargs: Passed to the Endpointer, e.g. {"hangover": 0.8}
+        backend_endpoint_delay: Seconds of silence the speech-to-text engine is assumed to need to end an utterance by
+            itself, until it has been seen doing so; what local endpointing saves is reported against it
+        """
+        self._porcupine = None
+        self._oww_model = None
+        self._audio_bus = audio_bus if audio_bus is not None else self._create_audio_bus()
+
+        # Speech-to-Text for Dream detection
+        if speech_backend is not None:
+            self._speech_backend = speech_backend
+        else:
+            try:
+                self._speech_backend = create_speech_backend(stt_backend, **(stt_backend_kwargs or dict()))
+            except Exception as e:
+                if stt_backend == GoogleSpeechBackend.name:
+                    raise
+                logger.error(f"Could not initialize {stt_backend} speech backend: {e}; falling back to Google Cloud")
+                self._speech_backend = GoogleSpeechBackend()
+        logger.info(f"Using {self._speech_backend} speech backend")
+        # Per backend latency of the dreams heard
+        self._stt_stats = dict()
+        self._local_endpointing = local_endpointing
+        self._endpointer_kwargs = endpointer_kwargs or dict()
+        self._backend_endpoint_delay = backend_endpoint_delay
+        self._endpoint_stats = {"local": 0, "backend": 0, "time_saved": 0.0, "audio_saved": 0.0}
+
+    @staticmethod
+    def _sha256(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _ensure_oww_models(wakeword_models, manifest_path=os.path.join("models", ".openwakeword-sha256.json")):
+        """Downloads the openWakeWord models only if they are missing or don't match the checksums recorded after the
+        last download, so that starting up doesn't need the network"""
+        import openwakeword
+        import openwakeword.utils
+
+        paths = [model["model_path"] for model in openwakeword.FEATURE_MODELS.values()]
+        paths += [openwakeword.MODELS[name]["model_path"] for name in wakeword_models]
+        paths = [path.replace(".tflite", ".onnx") for path in paths]
+
+        try:
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = dict()
+
+        invalid = [path for path in paths if not os.path.isfile(path) or manifest.get(path) != Listener._sha256(path)]
+        if not invalid:
+            logger.info("openWakeWord models found in cache")
+            return
+
+        logger.info(f"Downloading openWakeWord models: {invalid}")
+        # Into a directory of its own, as download_models skips the files that exist (a corrupt one would stay), and so
+        # that the installed models, which may well be fine (e.g. from before the manifest), survive a failed download
+        models_dir = os.path.dirname(invalid[0])
+        try:
+            with tempfile.TemporaryDirectory(dir=models_dir) as download_dir:
+                openwakeword.utils.download_models(model_names=list(wakeword_models), target_directory=download_dir)
+                for path in invalid:
+                    downloaded = os.path.join(download_dir, os.path.basename(path))
+                    if os.path.isfile(downloaded):
+                        os.replace(downloaded, path)
+        except Exception as e:
+            if not all(os.path.isfile(path) for path in paths):
+                raise
+            logger.warning(f"Could not download the openWakeWord models ({e}); using the installed ones")
+            return
 
+        manifest.update({path: Listener._sha256(path) for path in paths})
+        os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def _create_audio_bus(self):
         # PicoVoice for Wake word detection
         pico_access_key = self._read_pico_access_key()
-        self._porcupine = None
-        self._porcupine_recorder = None
+        detectors = list()
 
         # Initialize openWakeWord as backup wake word detection
         # Available wake words: "hey_jarvis", "alexa", "hey_mycroft", "hey_rhasspy"
@@ -161,47 +701,45 @@ class Listener:
         #   - 'tflite': Uses TensorFlow Lite, larger but more compatible with TF ecosystem
         try:
             logger.info("Initializing openWakeWord (backup wake word detection)...")
-            openwakeword.utils.download_models()
+            self._ensure_oww_models(Listener._oww_wake_words)
+            from openwakeword.model import Model
             self._oww_model = Model(
-                wakeword_models=["hey_jarvis"],
+                wakeword_models=Listener._oww_wake_words,
                 inference_framework='onnx'  # 'onnx' (recommended) or 'tflite'
             )
-            self._oww_last_detection_time = 0  # For debouncing across calls
-            logger.info("openWakeWord initialized successfully with 'hey jarvis' model")
+            logger.info(f"openWakeWord initialized successfully with {Listener._oww_wake_words} models")
         except Exception as e:
             logger.error(f"Could not initialize openWakeWord: {e}")
             self._oww_model = None
 
         try:
+            import pvporcupine
             self._porcupine = pvporcupine.create(
                 access_key=pico_access_key,
                 keywords=Listener._wake_keywords,
                 keyword_paths=["models/I-have-a-dream_en_raspberry-pi_v3_0_0.ppn"],
                 sensitivities=[0.3]
             )
-            self._porcupine_recorder = PvRecorder(frame_length=self._porcupine.frame_length)
+            detectors.append(PorcupineDetector(self._porcupine, Listener._wake_keywords))
         except Exception as e:
             logger.error(f"Could not initialize Porcupine {e}")
 
-        # Google Cloud Speech-to-Text for Dream detection
-        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = ".google-api-key.json"
-
-        self._speech_client = speech.SpeechClient()
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
-            sample_rate_hertz=16000,
-            language_code="en-US",
-        )
+        if self._oww_model:
+            # The model only runs while there's something to hear
+            detectors.append(OpenWakeWordDetector(self._oww_model, gate=EnergyGate(OpenWakeWordDetector.frame_length)))
 
-        self._streaming_config = speech.StreamingRecognitionConfig(
-            config=config,
-            interim_results=True,
-            single_utterance=True
-        )
+        # Both detectors listen to the same capture stream at the same time
+        if detectors:
+            try:
+                return AudioBus(detectors)
+            except Exception as e:
+                logger.error(f"Could not initialize audio capture: {e}")
+        return None
 
     @staticmethod
     def _find_usb_mic():
         """Find USB microphone device index by searching device names"""
+        import pyaudio
         p = pyaudio.PyAudio()
         for i in range(p.get_device_count()):
             info = p.get_device_info_by_index(i)
@@ -240,152 +778,123 @@ class Listener:
             access_key = None
         return access_key
 
-    def _listen_for_wake_phrase(self):
-        if not self._porcupine_recorder:
-            return None
-
-        self._porcupine_recorder.start()
-        logger.info("Listening for wake phrase...")
-
+    def warm_up(self):
+        """Loads the speech-to-text engine ahead of the first dream"""
         try:
-            while self._porcupine_recorder.is_recording:
-                pcm = self._porcupine_recorder.read()
-                keyword_index = self._porcupine.process(pcm)
-
-                # Wake phrase detected
-                if keyword_index >= 0:
-                    logger.info(f" Detected {self._wake_keywords[keyword_index]}")
-                    self._porcupine_recorder.stop()
-                    return self._wake_keywords[keyword_index]
-
+            self._speech_backend.warm_up()
         except Exception as e:
-            logger.error(e)
-            if self._porcupine_recorder:
-                self._porcupine_recorder.stop()
+            logger.error(f"Could not warm up {self._speech_backend} speech backend: {e}")
 
-        return None
-
-    def _listen_for_oww(self):
-        """Listen for 'hey jarvis' wake word using openWakeWord with PvRecorder"""
-        if not self._oww_model:
+    def listen_for_wake(self):
+        if not self._audio_bus:
             return None
 
-        # Reset model state to clear any cached audio from previous detections
-        self._oww_model.reset()
-
-        logger.info(f"Listening for 'hey jarvis' using openWakeWord... (last detection: {self._oww_last_detection_time})")
-
-        # openWakeWord needs 1280 samples per chunk (80ms at 16kHz)
-        # PvRecorder frame_length will be 512 by default, so we'll accumulate frames
-        frame_length = 512
-        oww_chunk_size = 1280  # 80ms at 16kHz
-        debounce_time = 5.0  # Ignore detections for 5 seconds after first detection
-
+        logger.info("Listening for wake phrase...")
         try:
-            recorder = PvRecorder(frame_length=frame_length)
-            recorder.start()
-
-            audio_buffer = np.array([], dtype=np.int16)
-
-            while recorder.is_recording:
-                pcm = recorder.read()
-
-                # Accumulate audio frames
-                audio_buffer = np.append(audio_buffer, pcm)
-
-                # Process when we have enough samples for openWakeWord
-                if len(audio_buffer) >= oww_chunk_size:
-                    # Take exactly oww_chunk_size samples
-                    audio_chunk = audio_buffer[:oww_chunk_size]
-                    audio_buffer = audio_buffer[oww_chunk_size:]
-
-                    # Get predictions from openWakeWord
-                    prediction = self._oww_model.predict(audio_chunk)
-
-                    # Check if wake word detected
-                    for wake_word, score in prediction.items():
-                        # Log scores periodically for debugging (every 100 chunks)
-                        if np.random.rand() < 0.01:  # ~1% of the time
-                            logger.debug(f"'{wake_word}' score: {score:.3f}")
-
-                        if score > 0.5:  # Detection threshold
-                            current_time = time.time()
-                            time_since_last = current_time - self._oww_last_detection_time
-
-                            # Check debounce - ignore if detected recently
-                            if time_since_last < debounce_time:
-                                logger.info(f"Ignoring duplicate detection (debounce: {time_since_last:.1f}s < {debounce_time}s)")
-                                continue
-
-                            logger.info(f"Detected '{wake_word}' (confidence: {score:.2f})")
-                            logger.info(f"Setting debounce timer to {current_time}")
-                            self._oww_last_detection_time = current_time  # Update debounce timer
-                            recorder.stop()
-                            recorder.delete()
-                            return wake_word
-
+            detector, wake_word = self._audio_bus.listen()
         except Exception as e:
-            logger.error(f"Error in openWakeWord detection: {e}")
-            if recorder and recorder.is_recording:
-                recorder.stop()
-            if recorder:
-                recorder.delete()
+            logger.error(f"Error in wake word detection: {e}")
+            self._audio_bus.stop()
             return None
 
-    def listen_for_wake(self):
-        if self._porcupine and self._porcupine_recorder:
-            result = self._listen_for_wake_phrase()
-            if result:
-                return result
+        # The bus keeps recording, so that the dream picks up right where the wake phrase ended
+        return wake_word
+
+    def get_wake_stats(self):
+        return self._audio_bus.detection_stats if self._audio_bus else dict()
 
-        return self._listen_for_oww()
+    def _create_endpointer(self):
+        if not self._local_endpointing:
+            return None
+        kwargs = dict(self._endpointer_kwargs)
+        if self._audio_bus and "noise_floor" not in kwargs:
+            # The audio around the wake phrase tells how loud the room is
+            ring = self._audio_bus.ring
+            pcm = np.concatenate(ring.views_since(0) or [np.zeros(0, dtype=np.int16)])
+            kwargs["noise_floor"] = Endpointer.estimate_noise_floor(pcm)
+        return Endpointer(**kwargs)
+
+    def _open_dream_stream(self, endpointer=None):
+        if self._audio_bus and self._audio_bus.is_recording:
+            return AudioBusStream(self._audio_bus, self._audio_bus.wake_position, endpointer=endpointer)
+        return MicrophoneStream(endpointer=endpointer)
 
     def listen_for_dream(self):
         logger.info("Listening for dream...")
-        with MicrophoneStream() as stream:
+        try:
+            yield from self._listen_for_dream()
+        finally:
+            # Until the next wake cycle, nobody would read the audio
+            if self._audio_bus:
+                self._audio_bus.stop()
+
+    def _listen_for_dream(self):
+        latency = TranscriptLatency()
+        endpointer = self._create_endpointer()
+        with self._open_dream_stream(endpointer) as stream:
             audio_generator = stream.generator()
 
-            requests = (
-                speech.StreamingRecognizeRequest(audio_content=content)
-                for content in audio_generator
-            )
-
-            responses = self._speech_client.streaming_recognize(self._streaming_config, requests)
-
-            finalized_transcript = str()
-
             try:
-                for response in responses:
-                    logger.info(f"Response from Google Cloud:\n{response}")
-                    if not response.results:
-                        if response.speech_event_type == speech.StreamingRecognizeResponse.SpeechEventType.END_OF_SINGLE_UTTERANCE:
-                            break
-                        continue
-
-                    if not response.results[0].alternatives:
-                        continue
-
-                    current_transcript = str()
-                    # We take transcription of the top alternative from all the results as some chunks might never be deemed "is_final".
-                    for result in response.results:
-                        this_transcript = result.alternatives[0].transcript
-
-                        if result.is_final:
-                            finalized_transcript += this_transcript
-                        else:
-                            current_transcript += this_transcript
-
-                    full_transcript = finalized_transcript + " " + current_transcript
+                for full_transcript in self._speech_backend.transcribe(audio_generator):
+                    latency.update(full_transcript)
                     yield full_transcript
             except Exception as e:
                 logger.error(f"Error caught:\n{e}")
                 yield ""
 
+        self._record_stt_latency(latency)
+        if endpointer:
+            self._record_endpointing(endpointer)
+
+    def _record_stt_latency(self, latency):
+        if latency.first_word is None:
+            return
+        stats = self._stt_stats.setdefault(str(self._speech_backend), {"dreams": 0, "avg_first_word": 0.0})
+        stats["dreams"] += 1
+        stats["avg_first_word"] += (latency.first_word - stats["avg_first_word"]) / stats["dreams"]
+        stats["last_first_word"] = latency.first_word
+        stats["last_final"] = latency.final
+        metrics.observe("stt_first_word", latency.first_word, backend=self._speech_backend)
+        metrics.observe("stt_final", latency.final, backend=self._speech_backend)
+        logger.info(f"{self._speech_backend}: first word after {latency.first_word:.2f}s, "
+                    f"final transcript after {latency.final:.2f}s")
+
+    def get_stt_stats(self):
+        return self._stt_stats
+
+    def _record_endpointing(self, endpointer):
+        """Estimates what ending the stream on the device saved, compared to the speech-to-text engine ending it"""
+        if not endpointer.speech_detected:
+            return
+        stats = endpointer.stats()
+        if not endpointer.ended:
+            self._endpoint_stats["backend"] += 1
+            metrics.increment("endpoints", by="backend")
+            # The engine ended the utterance first, which shows how long it takes to do that, unless it was still loud
+            if stats["since_speech"] > 0:
+                self._backend_endpoint_delay += 0.2 * (stats["since_speech"] - self._backend_endpoint_delay)
+            logger.info(f"{self._speech_backend} ended the utterance {stats['since_speech']:.2f}s after the speech")
+            return
+
+        # Without it, the engine would have kept listening (and billing) until its own endpoint, and from the start
+        time_saved = max(0.0, self._backend_endpoint_delay - stats["since_speech"])
+        audio_saved = stats["leading_trimmed"] + max(0.0, self._backend_endpoint_delay - stats["trailing_sent"])
+        self._endpoint_stats["local"] += 1
+        self._endpoint_stats["time_saved"] += time_saved
+        self._endpoint_stats["audio_saved"] += audio_saved
+        metrics.increment("endpoints", by="local")
+        metrics.observe("endpoint_time_saved", time_saved)
+        metrics.observe("endpoint_audio_saved", audio_saved)
+        logger.info(f"Local endpointing saved ~{time_saved * 1000:.0f}ms and ~{audio_saved:.2f}s of audio "
+                    f"({stats['sent']:.2f}s of {stats['heard']:.2f}s sent)")
+
+    def get_endpoint_stats(self):
+        """Dreams ended on the device and by the speech-to-text engine, and the seconds and audio seconds saved"""
+        return dict(self._endpoint_stats, backend_endpoint_delay=self._backend_endpoint_delay)
+
     def shutdown(self):
-        if self._porcupine_recorder and self._porcupine_recorder.is_recording:
-            self._porcupine_recorder.stop()
-        if self._porcupine_recorder:
-            self._porcupine_recorder.delete()
+        if self._audio_bus:
+            self._audio_bus.delete()
 
         if self._porcupine:
             self._porcupine.delete()
@@ -1,43 +1,105 @@
+import argparse
+import concurrent.futures
 import logging
-import random
+import os
 import threading
 import time
-from enum import Enum, auto
-from pathlib import Path
 
 import coloredlogs
 
 from displayer import Displayer
+from dream_frame import DreamFrame
+from dream_server import DreamServer
 from dreamer import Dreamer
 from listener import Listener
+from metrics import metrics
+from prefetcher import DreamPrefetcher
+from scheduler import DreamScheduler, Priority, State
+from speculator import DreamSpeculator
 
 coloredlogs.install(fmt='%(asctime)s %(name)s[%(process)d] %(levelname)s %(message)s')
 
 logger = logging.getLogger(__name__)
 
 
-class State(Enum):
-    STARTUP = auto()
-    LISTENING = auto()
-    LOADING = auto()
-    IMAGE = auto()
+def create_dreamer():
+    # Race the next provider if the current one is slow, but never pay for more than one paid image per prompt (the cap
+    # is per 1024x1024 image, like the providers' prices, and scales with the size of the dreams like they do)
+    return Dreamer(hedge_delay=15, max_request_cost=0.0015)
+
+
+def seconds_since_start():
+    """Seconds since the system booted and since this process started, or (None, None) where /proc is not available"""
+    try:
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        with open("/proc/self/stat", "r") as f:
+            # Fields are counted after the command name, which may contain spaces. Start time is the 22nd field.
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return uptime, uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None, None
 
 
 class Dreamscaper:
 
-    def __init__(self):
-        self._dreamer = Dreamer()
-        self._listener = Listener()
-        self._displayer = Displayer()
+    def __init__(self, dreamer=None, listener=None, displayer=None, startup_budget=5.0, progressive_on_demand=True,
+                 progressive_periodic=False, speculate=True):
+        """
+        The parts are created with the app's settings unless given, e.g. by the benchmarks.
+        startup_budget: Seconds from the process start within which the logo should be up; a warning is logged if not
+        progressive_on_demand: Show a quick low-resolution draft of a spoken dream while the final image is generated
+        progressive_periodic: Instead of waiting for the prefetch queue when it is empty, generate a periodic dream on
+            the spot and show its draft first
+        speculate: Start generating a spoken dream once the transcript stops changing, before listening has ended
+        """
+        self._progressive_on_demand = progressive_on_demand
+        self._progressive_periodic = progressive_periodic
+        # Dreams that were asked for come back more often among the past dreams than the random ones
+        self._spoken_dream_weight = 2.0
+        self._displayer = displayer or Displayer()
+        # The logo goes up before anything slow is loaded
+        self._displayer.show_startup()
+        self._report_startup("logo", startup_budget)
+
+        # Listener and dreamer load independent things (wake word models, providers), so they are loaded side by side
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            dreamer_future = executor.submit(create_dreamer) if not dreamer else None
+            # "vosk" recognizes the dream on the device instead of Google Cloud; see README
+            listener_future = executor.submit(Listener, stt_backend="google") if not listener else None
+            self._dreamer = dreamer or dreamer_future.result()
+            self._listener = listener or listener_future.result()
+        self._report_startup("ready")
+
         self._app_running = threading.Event()
-        self._displayer_lock = threading.Lock()
-        self._last_image_ts = 0
-        self._last_image_lock = threading.Lock()
-        self._last_image = "assets/logo.jpeg"
         self._image_size = self.get_image_size()
-        # State machine
-        self._state = State.STARTUP
-        self._state_lock = threading.Lock()
+        # A dream is given up on if the final transcript differs, so at most one request per dream is wasted
+        self._speculator = DreamSpeculator(self._dreamer, max_wasted=1 if speculate else 0)
+        # Owns the state machine and hands the display to one dream at a time, on-demand before periodic
+        self._scheduler = DreamScheduler(initial_image="assets/logo.jpeg")
+        # Periodic dreams are generated ahead of time, in the early hours, so that showing one never waits on the network
+        self._prefetcher = DreamPrefetcher(self._dreamer,
+                                           self._image_size,
+                                           capacity=3,
+                                           low_water=1,
+                                           is_idle=lambda: not self._scheduler.is_busy(),
+                                           off_peak_hours=(1, 6))
+
+    @staticmethod
+    def _report_startup(stage, budget=None):
+        since_boot, since_process_start = seconds_since_start()
+        if since_process_start is None:
+            return
+        metrics.observe("startup", since_process_start, stage=stage)
+        logger.info(f"Startup: {stage} {since_process_start:.2f}s after process start, {since_boot:.1f}s after boot")
+        if budget and since_process_start > budget:
+            logger.warning(f"Startup: {stage} took longer than the budget of {budget}s")
+
+    def _warm_up(self):
+        """Loads what the first dream would otherwise wait for"""
+        self._listener.warm_up()
+        self._dreamer.warm_up()
+        self._report_startup("warm")
 
     def get_image_size(self):
         # Image size has to be such that the aspect ratio is maintained but the height is at default 1024
@@ -55,101 +117,149 @@ class Dreamscaper:
                 logger.info(f"Terminating on-demand dream thread as listen_for_wake was terminated")
                 break
 
+            # Any periodic dream still being prepared is dropped
+            claim = self._scheduler.claim(Priority.ON_DEMAND)
             self.set_state(State.LISTENING)
-
-            with self._displayer_lock:
-                self._displayer.clear_screen()
-                self._displayer.show_listening()
-
-                dream_text = str()
-
-                for dream_text in self._listener.listen_for_dream():
-                    logger.info(f"dream_text = {dream_text}")
-                    self._displayer.show_dream_prompt(dream_text)
-
-                self._displayer.stop_show_listening()
-
-                # No prompt was heard
-                if not dream_text:
-                    self._displayer.show_image(self._last_image)
-                    self.set_state(State.IMAGE)
-                    continue
-
-                self._displayer.show_loading()
-                self.set_state(State.LOADING)
-
-                dream_img = self._dreamer.visualize(dream_text,
-                                                    width=self._image_size[0],
-                                                    height=self._image_size[1])
-
-                self._displayer.stop_show_loading()
-
-                if not dream_img:
-                    self._displayer.show_message("Error generating image; Try again")
-                    time.sleep(5)
-                    self._displayer.show_image(self._last_image)
-                    self.set_state(State.IMAGE)
-                    continue
-
-                self._displayer.show_image(dream_img)
-                self.set_state(State.IMAGE)
-
-            self.set_last_image_ts(time.time(), dream_img)
-
-    def periodic_dream(self, period=86400):
-        while True:
-            dream_text = self._dreamer.imagine()
+            wake_ts = time.monotonic()
+            try:
+                with claim as granted:
+                    dream_img = self._dream_on_demand(wake_ts) if granted else None
+                # Before the claim is closed, so that the periodic dream's timer starts from this one
+                if dream_img:
+                    self.set_last_image_ts(time.time(), dream_img)
+            finally:
+                claim.close()
+
+    def _dream_on_demand(self, wake_ts):
+        """Listens to, visualizes and shows a dream while holding the display. Returns the image, or None."""
+        self._displayer.clear_screen()
+        self._displayer.show_listening()
+
+        dream_text = str()
+        self._speculator.begin(width=self._image_size[0],
+                               height=self._image_size[1],
+                               weight=self._spoken_dream_weight)
+
+        for dream_text in self._listener.listen_for_dream():
+            logger.info(f"dream_text = {dream_text}")
+            self._displayer.show_dream_prompt(dream_text)
+            self._speculator.update(dream_text)
+
+        self._displayer.stop_show_listening()
+
+        # No prompt was heard
+        if not dream_text:
+            self._speculator.cancel()
+            self._displayer.show_image(self._scheduler.get_last_image())
+            self.set_state(State.IMAGE)
+            return None
+
+        self._displayer.show_loading()
+        self.set_state(State.LOADING)
+
+        # The dream may have been started speculatively, while it was still being told
+        dream_img = self._speculator.finish(dream_text)
+        if not dream_img and self._progressive_on_demand:
+            dream_img = self._dreamer.visualize_progressive(dream_text,
+                                                            on_draft=self._show_draft,
+                                                            width=self._image_size[0],
+                                                            height=self._image_size[1],
+                                                            weight=self._spoken_dream_weight)
+        elif not dream_img:
             dream_img = self._dreamer.visualize(dream_text,
                                                 width=self._image_size[0],
-                                                height=self._image_size[1])
-
-            # If dream image could not be generated, choose a random one from the repo
-            if not dream_img:
-                dream_img = self.get_random_image_from_past()
-                logger.info(f"Repeating dream {dream_img}")
-
-            # Don't want to display an image if in on-demand mode
-            # or if the last image was displayed less than `period` seconds ago
-            while (self.get_state() in (State.LISTENING, State.LOADING)) or (
-                    time.time() - self.get_last_image_ts() < period):
-                time.sleep(1)
-
-            with self._displayer_lock:
-                self._displayer.show_image(dream_img)
-                self.set_state(State.IMAGE)
-
-            self.set_last_image_ts(time.time(), dream_img)
-
-    @staticmethod
-    def get_random_image_from_past():
-        imgs = [f for f in Path("dreams").iterdir() if f.is_file()]
-
-        if imgs:
-            return random.choice(imgs)
-        else:
-            return "assets/logo.jpeg"
+                                                height=self._image_size[1],
+                                                weight=self._spoken_dream_weight)
+
+        self._displayer.stop_show_loading()
+
+        if not dream_img:
+            self._displayer.show_message("Error generating image; Try again")
+            time.sleep(5)
+            self._displayer.show_image(self._scheduler.get_last_image())
+            self.set_state(State.IMAGE)
+            return None
+
+        self._displayer.show_image(dream_img)
+        self.set_state(State.IMAGE)
+        metrics.observe("wake_to_image", time.monotonic() - wake_ts)
+        return dream_img
+
+    def _show_draft(self, draft_img):
+        """Replaces the loading animation with the draft of an on-demand dream (its claim already holds the display)"""
+        self._displayer.stop_show_loading()
+        self._displayer.show_image(draft_img)
+
+    def _dream_progressively(self, claim):
+        """Generates a periodic dream on the spot, showing its draft first, unless `claim` is preempted"""
+
+        def show_draft(draft_img):
+            with claim as granted:
+                if granted:
+                    self._displayer.show_image(draft_img)
+
+        return self._dreamer.visualize_progressive(self._dreamer.imagine(),
+                                                   on_draft=show_draft,
+                                                   width=self._image_size[0],
+                                                   height=self._image_size[1])
+
+    def periodic_dream(self, period=86400, prefetch_wait=120):
+        # Sleeps until the last image has been up for `period` seconds, and no one is talking to the device
+        while self._scheduler.wait_until_due(period):
+            # From here on, an on-demand dream takes precedence and this one is dropped
+            claim = self._scheduler.claim(Priority.PERIODIC)
+            try:
+                dream_img, prefetched = self._prepare_periodic_dream(claim, prefetch_wait)
+                with claim as granted:
+                    if not granted:
+                        logger.info(f"Dropping periodic dream {dream_img} for an on-demand one")
+                        if prefetched:
+                            # Still unseen; it is the next periodic dream instead
+                            self._prefetcher.put_back(dream_img)
+                        continue
+                    self._displayer.show_image(dream_img)
+                    self.set_state(State.IMAGE)
+                self.set_last_image_ts(time.time(), dream_img)
+            finally:
+                claim.close()
+
+    def _prepare_periodic_dream(self, claim, prefetch_wait):
+        """Returns (dream image, whether it was taken from the prefetch queue)"""
+        if claim.preempted:
+            return None, False
+        # The queue is normally stocked; it is only worth waiting for when it is being filled for the first time
+        dream_img = self._prefetcher.get(timeout=0 if self._progressive_periodic else prefetch_wait)
+        if dream_img:
+            return dream_img, True
+
+        if self._progressive_periodic and not claim.preempted:
+            dream_img = self._dream_progressively(claim)
+
+        # If no dream is ready, choose a random one from the archive
+        if not dream_img:
+            dream_img = self.get_random_image_from_past()
+            logger.info(f"Repeating dream {dream_img}")
+        return dream_img, False
+
+    def get_random_image_from_past(self):
+        return self._dreamer.get_random_dream() or "assets/logo.jpeg"
 
     def set_state(self, state):
-        with self._state_lock:
-            self._state = state
-        logger.info(f"State set to {state}")
+        self._scheduler.set_state(state)
 
     def get_state(self):
-        with self._state_lock:
-            return self._state
+        return self._scheduler.get_state()
 
     def set_last_image_ts(self, ts, image):
-        with self._last_image_lock:
-            self._last_image_ts = ts
-            self._last_image = image
-        logger.info(f"Last image was {image}\nDisplayed at {ts}")
+        self._dreamer.mark_shown(image)
+        self._scheduler.set_last_image(image, ts)
 
     def get_last_image_ts(self):
-        with self._last_image_lock:
-            return self._last_image_ts
+        return self._scheduler.get_last_image_ts()
 
     def run(self):
-        self._displayer.show_startup()
+        threading.Thread(target=self._warm_up, daemon=True).start()
+        self._prefetcher.start()
 
         listener_thread = threading.Thread(target=self.on_demand_dream,
                                            kwargs={"timeout": 5},
@@ -168,10 +278,52 @@ class Dreamscaper:
             logger.error(e)
 
         finally:
+            self._scheduler.stop()
+            self._prefetcher.stop()
             self._listener.shutdown()
+            self._dreamer.shutdown()
             self._displayer.shutdown()
 
 
 if __name__ == "__main__":
-    dreamscaper = Dreamscaper()
-    dreamscaper.run()
+    parser = argparse.ArgumentParser(description="Dreamscaper")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--serve", action="store_true",
+                      help="Generate dreams for a fleet of frames instead of showing them (see --frame)")
+    mode.add_argument("--frame", metavar="SERVER_URL",
+                      help="Show the dreams of a server started with --serve, e.g. http://dreamserver:8700/")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Interface to serve on, with --serve; e.g. 0.0.0.0 for frames on other devices, which "
+                             "needs --token")
+    parser.add_argument("--port", type=int, default=8700, help="Port to serve on, with --serve")
+    parser.add_argument("--token", default=os.environ.get("DREAMSCAPER_TOKEN"),
+                        help="Secret that requests for new dreams have to present, with --serve "
+                             "(default: $DREAMSCAPER_TOKEN)")
+    parser.add_argument("--size", default="1824x1024",
+                        help="WIDTHxHEIGHT of the dreams, with --serve; frames scale them to their screens, so match "
+                             "their aspect ratio, with a height of 1024 and a width that is a multiple of 16")
+    parser.add_argument("--metrics-port", type=int, default=9464,
+                        help="Port to serve Prometheus metrics on at http://127.0.0.1:<port>/metrics; 0 disables them. "
+                             "Give each process on a host its own, e.g. when running --serve and --frame side by side")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        metrics.enable(http_port=args.metrics_port)
+
+    if args.serve:
+        try:
+            image_size = tuple(int(side) for side in args.size.lower().split("x"))
+        except ValueError:
+            image_size = ()
+        if len(image_size) != 2:
+            parser.error(f"--size has to be WIDTHxHEIGHT, not {args.size}")
+        server_dreamer = create_dreamer()
+        # Nobody is talking to a server, so it may prefetch at any time
+        server_prefetcher = DreamPrefetcher(server_dreamer, image_size, is_idle=lambda: True, off_peak_hours=(1, 6))
+        DreamServer(server_dreamer, host=args.host, port=args.port, image_size=image_size, prefetcher=server_prefetcher,
+                    token=args.token).run()
+    elif args.frame:
+        DreamFrame(args.frame, Displayer()).run()
+    else:
+        dreamscaper = Dreamscaper()
+        dreamscaper.run()
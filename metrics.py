@@ -0,0 +1,171 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class _Span:
+    __slots__ = ("_metrics", "_name", "_labels", "_t0")
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._metrics.observe(self._name, time.perf_counter() - self._t0, **self._labels)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Metrics:
+    """Timings (in seconds) and counters of the app, exposed as Prometheus text on a local HTTP port and/or appended to
+    a JSONL file. Until `enable` is called everything is a no-op, so instrumented code pays next to nothing."""
+
+    def __init__(self, prefix="dreamscaper"):
+        self._prefix = prefix
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._timings = dict()  # (name, labels) -> [count, sum, max]
+        self._counters = dict()  # (name, labels) -> value
+        self._jsonl = None
+        self._server = None
+
+    def enable(self, http_port=None, http_host="127.0.0.1", jsonl_path=None):
+        """
+        http_port: Serve the metrics at http://<http_host>:<http_port>/metrics. If the port is taken (e.g. by another
+            instance of the app on the same host), the metrics are still collected, just not served
+        jsonl_path: Append every timing and counter increment to this file
+        """
+        if jsonl_path:
+            self._jsonl = open(jsonl_path, "a", buffering=1)
+        if http_port:
+            self._start_http_server(http_host, http_port)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        if self._server:
+            self._server.shutdown()
+            self._server = None
+        if self._jsonl:
+            self._jsonl.close()
+            self._jsonl = None
+
+    def span(self, name, **labels):
+        """Context manager timing its block as `name`"""
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, name, labels)
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, self._label_items(labels))
+        with self._lock:
+            timing = self._timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+        self._write_jsonl("timing", key, seconds)
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, self._label_items(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._write_jsonl("counter", key, value)
+
+    @staticmethod
+    def _label_items(labels):
+        # Label values may be any object, e.g. an inference client
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def _write_jsonl(self, kind, key, value):
+        if not self._jsonl:
+            return
+        name, labels = key
+        line = json.dumps({"ts": time.time(), "type": kind, "name": name, "labels": dict(labels), "value": value})
+        with self._lock:
+            self._jsonl.write(line + "\n")
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def prometheus_text(self):
+        lines = list()
+        with self._lock:
+            timings = sorted(self._timings.items())
+            counters = sorted(self._counters.items())
+
+        # The samples of a metric family have to be grouped together, so each timing is a summary family (count and
+        # sum) followed by a separate gauge family for its max
+        families = dict()  # metric -> (type, [sample lines]), in the order they are first seen
+        for (name, labels), (count, total, maximum) in timings:
+            metric = f"{self._prefix}_{name}_seconds"
+            summary = families.setdefault(metric, ("summary", list()))[1]
+            summary.append(f"{metric}_count{self._format_labels(labels)} {count}")
+            summary.append(f"{metric}_sum{self._format_labels(labels)} {total}")
+            families.setdefault(f"{metric}_max", ("gauge", list()))[1].append(
+                f"{metric}_max{self._format_labels(labels)} {maximum}")
+
+        for (name, labels), value in counters:
+            metric = f"{self._prefix}_{name}_total"
+            families.setdefault(metric, ("counter", list()))[1].append(f"{metric}{self._format_labels(labels)} {value}")
+
+        for metric, (metric_type, samples) in families.items():
+            lines.append(f"# TYPE {metric} {metric_type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+    def _start_http_server(self, host, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            logger.warning(f"Not serving metrics, as {host}:{port} can't be listened on: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+
+
+# Shared by the whole app
+metrics = Metrics()
@@ -0,0 +1,142 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from image_writer import image_writer
+from json_state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+
+class DreamPrefetcher:
+    """Keeps a bounded queue of ready-to-show dreams, generated in the background while the device is idle.
+    Once the queue drains to `low_water` dreams, it is refilled up to `capacity`, but only during the off-peak window
+    (if any). An empty queue is refilled right away regardless of the window, so that there is always something to show.
+    The queue is persisted so that dreams generated before a restart are not wasted.
+    """
+
+    def __init__(self, dreamer, image_size, capacity=3, low_water=1, is_idle=None, off_peak_hours=None,
+                 retry_interval=600, check_interval=60, state_path=None):
+        """
+        dreamer: Dreamer used to imagine and visualize the dreams
+        image_size: (width, height) of the dreams
+        is_idle: Callable returning False while the device is busy (e.g. listening to an on-demand dream)
+        off_peak_hours: (start_hour, end_hour) in local time during which the queue is topped up, e.g. (1, 6).
+            The window may wrap around midnight. None means any time.
+        retry_interval: Seconds to wait after a dream could not be generated
+        check_interval: Seconds between checks of whether the device is idle or in the off-peak window
+        state_path: Where the queue is persisted; by default in the dreamer's dreams directory, next to the dreams
+        """
+        if not 0 <= low_water < capacity:
+            raise ValueError(f"low_water ({low_water}) must be smaller than capacity ({capacity})")
+        self._dreamer = dreamer
+        self._image_size = image_size
+        self._capacity = capacity
+        self._low_water = low_water
+        self._is_idle = is_idle or (lambda: True)
+        self._off_peak_hours = off_peak_hours
+        self._retry_interval = retry_interval
+        self._check_interval = check_interval
+        self._state_path = state_path or os.path.join(dreamer.get_dreams_dir(), ".prefetch_queue.json")
+
+        self._queue = deque(self._load_queue())
+        self._cond = threading.Condition()
+        self._refilling = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _load_queue(self):
+        paths = load_state(self._state_path, "prefetch queue") or []
+        return [path for path in paths if os.path.isfile(path)][:self._capacity]
+
+    def _save_queue(self):
+        save_state(self._state_path, list(self._queue))
+
+    def _in_off_peak_window(self):
+        if not self._off_peak_hours:
+            return True
+        start, end = self._off_peak_hours
+        hour = time.localtime().tm_hour
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def _should_generate(self):
+        """Called with the condition held"""
+        if len(self._queue) >= self._capacity:
+            self._refilling = False
+            return False
+        if len(self._queue) <= self._low_water:
+            self._refilling = True
+        if not self._refilling or not self._is_idle():
+            return False
+        return not self._queue or self._in_off_peak_window()
+
+    def _generate(self):
+        dream_text = self._dreamer.imagine()
+        logger.info(f"Prefetching dream: {dream_text}")
+        # Not a past dream until it's been shown, so it can't come up as a repeat before its turn (or be evicted)
+        return self._dreamer.visualize(dream_text,
+                                       width=self._image_size[0],
+                                       height=self._image_size[1],
+                                       shown=False)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._cond:
+                if not self._should_generate():
+                    self._cond.wait(timeout=self._check_interval)
+                    continue
+
+            dream_img = self._generate()
+
+            if not dream_img:
+                logger.error(f"Could not prefetch a dream; retrying in {self._retry_interval}s")
+                self._stopped.wait(self._retry_interval)
+                continue
+
+            with self._cond:
+                self._queue.append(dream_img)
+                self._save_queue()
+                logger.info(f"Prefetched {dream_img} ({len(self._queue)}/{self._capacity} ready)")
+                self._cond.notify_all()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def get(self, timeout=0):
+        """Pops the next ready dream. Waits up to `timeout` seconds if the queue is empty; returns None if still empty"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while self._queue:
+                    dream_img = self._queue.popleft()
+                    self._save_queue()
+                    # Wakes up the refill thread in case the low-water mark has been reached
+                    self._cond.notify_all()
+                    # The image may have been evicted from the cache in the meantime
+                    if image_writer.exists(dream_img):
+                        return dream_img
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(timeout=remaining)
+
+    def put_back(self, dream_img):
+        """Returns a dream from `get` that ended up not being shown to the front of the queue"""
+        with self._cond:
+            self._queue.appendleft(dream_img)
+            self._save_queue()
+            self._cond.notify_all()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._queue)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+import os
+import secrets
+import string
+import threading
+
+from json_state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+
+class PromptSampler:
+    """Walks through every combination of the prompt lists, e.g. adjectives x subjects x actions x objects x places, in a
+    pseudo-random order, so that no dream repeats until all of them have been dreamt.
+    The order is a keyed permutation of the combination numbers (a Feistel network, cycle-walked down to the number of
+    combinations), so only the key and the position are kept, not the combinations, and they are persisted to resume
+    after a restart. Once every combination has been used, a new permutation starts.
+    """
+    _rounds = 4
+
+    def __init__(self, prompt_lists, template="{adjectives} {subjects} {actions} {objects} {places}", weights=None,
+                 state_path=os.path.join("dreams", ".prompt_sampler.json")):
+        """
+        prompt_lists: Slot name -> list of phrases, e.g. from prompts/<slot>.txt
+        template: Slots in braces are filled in from their list. A new slot only needs a list of the same name.
+        weights: Slot name -> probability (0 to 1) that the slot is filled in at all; 1 by default. A slot that is
+            left out counts as one more phrase of its list, so that leaving it out doesn't produce repeats either.
+        """
+        self._template = template
+        self._slots = list(dict.fromkeys(name for _, name, _, _ in string.Formatter().parse(template) if name))
+        missing = [slot for slot in self._slots if not prompt_lists.get(slot)]
+        if missing:
+            raise ValueError(f"No prompts for template slots {missing}")
+        weights = weights or dict()
+        self._choices = list()
+        self._acceptance = list()  # Per slot: (probability to keep a combination with it filled in, with it left out)
+        for slot in self._slots:
+            phrases, weight = list(prompt_lists[slot]), min(max(weights.get(slot, 1.0), 0.0), 1.0)
+            if weight >= 1:
+                self._acceptance.append((1.0, 1.0))
+            elif weight <= 0:
+                phrases = [""]
+                self._acceptance.append((1.0, 1.0))
+            else:
+                # len(phrases) combinations with the slot filled in for every one with it left out. Thinning out one
+                # side makes the ratio of the combinations that are kept match the weight.
+                left_out = len(phrases) * (1 - weight) / weight
+                self._acceptance.append((1.0, left_out) if left_out <= 1 else (1 / left_out, 1.0))
+                phrases.append("")
+            self._choices.append(phrases)
+
+        self._size = 1
+        for phrases in self._choices:
+            self._size *= len(phrases)
+        # Feistel networks permute an even number of bits; combination numbers beyond `_size` are walked past
+        self._half_bits = max(1, ((self._size - 1).bit_length() + 1) // 2)
+        self._half_mask = (1 << self._half_bits) - 1
+
+        self._state_path = state_path
+        self._lock = threading.Lock()
+        self._signature = hashlib.sha256(json.dumps([template, self._choices, self._acceptance]).encode()).hexdigest()
+        self._state = self._load()
+
+    @property
+    def size(self):
+        """Number of combinations, including those thinned out by the weights"""
+        return self._size
+
+    def _new_state(self, epoch=0):
+        return {"signature": self._signature, "key": secrets.token_hex(16), "epoch": epoch, "position": 0}
+
+    def _load(self):
+        state = load_state(self._state_path, "prompt sampler state")
+        if state is None:
+            return self._new_state()
+        if state.get("signature") != self._signature:
+            logger.info("Prompt lists or template have changed; starting a new walk through the combinations")
+            return self._new_state()
+        return state
+
+    def _save(self):
+        save_state(self._state_path, self._state)
+
+    def _hash(self, *values):
+        data = ":".join(str(value) for value in (self._state["key"], self._state["epoch"]) + values).encode()
+        return int.from_bytes(hashlib.sha256(data).digest(), "big")
+
+    def _permute(self, number):
+        while True:
+            left, right = number >> self._half_bits, number & self._half_mask
+            for round_number in range(self._rounds):
+                left, right = right, left ^ (self._hash("round", round_number, right) & self._half_mask)
+            number = (left << self._half_bits) | right
+            if number < self._size:
+                return number
+
+    def _accepted(self, digits):
+        probability = 1.0
+        for phrases, digit, (filled_in, left_out) in zip(self._choices, digits, self._acceptance):
+            probability *= left_out if phrases[digit] == "" else filled_in
+        return probability >= 1 or self._hash("accept", digits) / 2 ** 256 < probability
+
+    def _digits(self, number):
+        digits = list()
+        for phrases in self._choices:
+            number, digit = divmod(number, len(phrases))
+            digits.append(digit)
+        return digits
+
+    def sample(self):
+        """Returns the next prompt"""
+        with self._lock:
+            while True:
+                if self._state["position"] >= self._size:
+                    logger.info(f"All {self._size} dream combinations have been used; starting over in a new order")
+                    self._state = self._new_state(epoch=self._state["epoch"] + 1)
+                digits = self._digits(self._permute(self._state["position"]))
+                self._state["position"] += 1
+                if self._accepted(digits):
+                    break
+            self._save()
+
+        phrases = {slot: self._choices[i][digit] for i, (slot, digit) in enumerate(zip(self._slots, digits))}
+        # Slots that are left out would leave double spaces behind
+        return " ".join(self._template.format(**phrases).split())
@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from json_state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+
+def rate_limit_backoff(exception, default=60):
+    """Seconds the provider asked to be left alone for, if `exception` is a rate limit (HTTP 429, or a 503 with a
+    Retry-After header), else None. Works with the errors of the OpenAI SDK (httpx) and huggingface_hub (requests),
+    which both carry the response."""
+    response = getattr(exception, "response", None)
+    status = getattr(exception, "status_code", None) or getattr(response, "status_code", None)
+    headers = getattr(response, "headers", None) or dict()
+    retry_after = headers.get("retry-after")
+    if status != 429 and not (status == 503 and retry_after):
+        return None
+    if not retry_after:
+        return default
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        # An HTTP date instead of seconds
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+def size_factor(height, width):
+    """Pixel count of an image relative to 1024x1024, which prices and caps are given for"""
+    return height * width / 1024 ** 2
+
+
+def image_cost(client, height=1024, width=1024):
+    """USD an image of the given size costs on the client, whose `cost_per_image` is for 1024x1024 and which bill by
+    the pixel"""
+    return client.cost_per_image * size_factor(height, width)
+
+
+class TokenBucket:
+    """Allows `rate` requests per minute on average, and bursts of up to `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self._rate = rate / 60
+        self._burst = burst or max(1.0, rate / 10)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self):
+        """Seconds until a request is allowed"""
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self._rate
+
+    def take(self):
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def give_back(self):
+        self._tokens = min(self._burst, self._tokens + 1)
+
+
+class ProviderQuotas:
+    """Keeps each client within its quotas, so that a request is only sent to a client that can take it rather than
+    finding out from a failed request:
+     - requests per minute, as a token bucket
+     - a monthly budget in USD, counted from the `image_cost` of every image received. The cost of a request is
+       reserved when it is acquired, so that requests in flight at the same time can't overshoot the budget together,
+       and refunded if it fails or is cancelled
+     - the backoff a client asked for with a rate limit response (see `rate_limit_backoff`)
+    Limits come from the client's `requests_per_minute` and `monthly_budget`, unless overridden by name in `limits`.
+    Spending and backoffs are keyed by the client's name and persisted to `state_path`, so that they survive restarts.
+    """
+
+    def __init__(self, state_path=os.path.join("dreams", ".provider_quotas.json"), limits=None):
+        """
+        limits: Client name -> {"requests_per_minute": ..., "monthly_budget": ...}; None means unlimited
+        """
+        self._state_path = state_path
+        self._limits = limits or dict()
+        self._lock = threading.Lock()
+        self._buckets = dict()
+        self._reserved = dict()  # Client name -> USD of requests in flight
+        self._quotas = self._load()
+
+    def _load(self):
+        return load_state(self._state_path, "provider quotas") or dict()
+
+    def _save(self):
+        save_state(self._state_path, self._quotas, indent=2)
+
+    def _limit(self, client, name):
+        return self._limits.get(str(client), dict()).get(name, getattr(client, name, None))
+
+    def _get(self, client):
+        month = time.strftime("%Y-%m")
+        quota = self._quotas.setdefault(str(client), {"month": month, "spent": 0.0, "images": 0, "blocked_until": 0.0})
+        if quota["month"] != month:
+            logger.info(f"New month; resetting the budget of {client}")
+            quota.update(month=month, spent=0.0, images=0)
+        return quota
+
+    def _bucket(self, client):
+        rate = self._limit(client, "requests_per_minute")
+        if not rate:
+            return None
+        if str(client) not in self._buckets:
+            self._buckets[str(client)] = TokenBucket(rate)
+        return self._buckets[str(client)]
+
+    def _over_budget(self, client, cost):
+        budget = self._limit(client, "monthly_budget")
+        # With some slack for rounding, as costs are fractions of a cent, so that the last image it pays for isn't refused
+        return budget is not None and \
+            self._get(client)["spent"] + self._reserved.get(str(client), 0.0) + cost > budget + 1e-9
+
+    def _wait_time(self, client, cost):
+        quota = self._get(client)
+        if self._over_budget(client, cost):
+            return float("inf")
+        bucket = self._bucket(client)
+        return max(quota["blocked_until"] - time.time(), bucket.wait_time() if bucket else 0.0, 0.0)
+
+    def wait_time(self, clients, height=1024, width=1024):
+        """Seconds until at least one of the clients can take a request for an image of the given size; 0 if one can
+        right away, inf if all of them are out of budget for the month"""
+        with self._lock:
+            return min((self._wait_time(client, image_cost(client, height, width)) for client in clients),
+                       default=float("inf"))
+
+    def has_capacity(self, client, height=1024, width=1024):
+        with self._lock:
+            return self._wait_time(client, image_cost(client, height, width)) == 0
+
+    def acquire(self, client, height=1024, width=1024):
+        """Uses up one request of the client's quota and reserves its cost, if it has enough of both left"""
+        cost = image_cost(client, height, width)
+        with self._lock:
+            if self._wait_time(client, cost) > 0:
+                return False
+            bucket = self._bucket(client)
+            if bucket and not bucket.take():
+                return False
+            self._reserved[str(client)] = self._reserved.get(str(client), 0.0) + cost
+            return True
+
+    def _unreserve(self, client, cost):
+        self._reserved[str(client)] = max(0.0, self._reserved.get(str(client), 0.0) - cost)
+
+    def release(self, client, height=1024, width=1024):
+        """Gives back a request that was acquired but never sent, and its cost"""
+        with self._lock:
+            self._unreserve(client, image_cost(client, height, width))
+            bucket = self._bucket(client)
+            if bucket:
+                bucket.give_back()
+
+    def refund(self, client, height=1024, width=1024):
+        """Gives back the cost of a request that was sent but failed or was cancelled; the request itself counts"""
+        with self._lock:
+            self._unreserve(client, image_cost(client, height, width))
+
+    def record_success(self, client, height=1024, width=1024):
+        """Turns the cost reserved for a request into spending"""
+        cost = image_cost(client, height, width)
+        with self._lock:
+            self._unreserve(client, cost)
+            quota = self._get(client)
+            quota["images"] += 1
+            quota["spent"] += cost
+            if self._over_budget(client, client.cost_per_image):
+                logger.warning(f"{client} has used up its monthly budget of ${self._limit(client, 'monthly_budget')}")
+            self._save()
+
+    def record_rate_limited(self, client, backoff):
+        with self._lock:
+            quota = self._get(client)
+            quota["blocked_until"] = max(quota["blocked_until"], time.time() + backoff)
+            logger.warning(f"{client} is rate limited; not using it for {backoff:.0f}s")
+            self._save()
+
+    def summary(self):
+        with self._lock:
+            return {name: dict(quota) for name, quota in self._quotas.items()}
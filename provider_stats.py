@@ -0,0 +1,148 @@
+import logging
+import os
+import threading
+import time
+from enum import Enum
+
+from json_state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"  # Client is healthy and used as ranked
+    OPEN = "open"  # Client kept failing and is skipped
+    HALF_OPEN = "half_open"  # A single probe request is allowed through to find out whether the client has recovered
+
+
+class ProviderStats:
+    """Keeps track of each client's latency and error rate (as exponentially weighted moving averages), guards every
+    client with a circuit breaker, and ranks the clients by their expected cost in seconds.
+    Stats are keyed by the client's name and persisted to `state_path` so that they survive restarts.
+    """
+
+    def __init__(self, state_path=os.path.join("dreams", ".provider_stats.json"), alpha=0.2, failure_threshold=3,
+                 open_interval=300, max_open_interval=3600, failure_penalty=60, seconds_per_dollar=10000,
+                 prior_latency=10):
+        """
+        alpha: Weight of the newest sample in the moving averages
+        failure_threshold: Consecutive failures after which the circuit of a client opens
+        open_interval: Seconds after which an open circuit lets a probe through. Doubles on every failed probe, up to
+            `max_open_interval`.
+        failure_penalty: Seconds a failure is assumed to cost, i.e. roughly the timeout
+        seconds_per_dollar: How many seconds of latency are worth paying one dollar to avoid
+        prior_latency: Latency assumed for a client until it has been used
+        """
+        self._state_path = state_path
+        self._alpha = alpha
+        self._failure_threshold = failure_threshold
+        self._open_interval = open_interval
+        self._max_open_interval = max_open_interval
+        self._failure_penalty = failure_penalty
+        self._seconds_per_dollar = seconds_per_dollar
+        self._prior_latency = prior_latency
+        self._lock = threading.Lock()
+        self._stats = self._load()
+
+    def _new_stats(self):
+        return {
+            "latency": None,
+            "error_rate": 0.0,
+            "consecutive_failures": 0,
+            "state": CircuitState.CLOSED,
+            "opened_at": 0.0,
+            "open_interval": self._open_interval,
+            "probe_in_flight": False,
+        }
+
+    def _load(self):
+        stats = load_state(self._state_path, "provider stats") or dict()
+
+        for name, client_stats in stats.items():
+            client_stats["state"] = CircuitState(client_stats["state"])
+            # A probe can't survive a restart
+            client_stats["probe_in_flight"] = False
+        return stats
+
+    def _save(self):
+        save_state(self._state_path, self._stats, indent=2)
+
+    def _get(self, client):
+        return self._stats.setdefault(str(client), self._new_stats())
+
+    def score(self, client):
+        """Expected seconds a request to the client costs, accounting for failures and price"""
+        with self._lock:
+            stats = self._get(client)
+            latency = stats["latency"] if stats["latency"] is not None else self._prior_latency
+            return (latency
+                    + stats["error_rate"] * self._failure_penalty
+                    + client.cost_per_image * self._seconds_per_dollar)
+
+    def ranked(self, clients):
+        """Clients ordered from best to worst score. Ties keep the given order."""
+        return sorted(clients, key=self.score)
+
+    def allow_request(self, client):
+        """Whether the client's circuit lets a request through. Moves an open circuit to half-open once its interval
+        has passed, in which case the request is the probe."""
+        with self._lock:
+            stats = self._get(client)
+            if stats["state"] == CircuitState.CLOSED:
+                return True
+
+            if stats["state"] == CircuitState.OPEN:
+                if time.time() - stats["opened_at"] < stats["open_interval"]:
+                    return False
+                stats["state"] = CircuitState.HALF_OPEN
+                logger.info(f"Circuit of {client} is half-open; sending a probe")
+
+            if stats["probe_in_flight"]:
+                return False
+            stats["probe_in_flight"] = True
+            return True
+
+    def release(self, client):
+        """Gives back a request that was allowed but never sent"""
+        with self._lock:
+            self._get(client)["probe_in_flight"] = False
+
+    def record_success(self, client, latency):
+        with self._lock:
+            stats = self._get(client)
+            stats["latency"] = latency if stats["latency"] is None else (
+                    self._alpha * latency + (1 - self._alpha) * stats["latency"])
+            stats["error_rate"] = (1 - self._alpha) * stats["error_rate"]
+            stats["consecutive_failures"] = 0
+            if stats["state"] != CircuitState.CLOSED:
+                logger.info(f"Circuit of {client} is closed again")
+            stats["state"] = CircuitState.CLOSED
+            stats["open_interval"] = self._open_interval
+            stats["probe_in_flight"] = False
+            self._save()
+
+    def record_failure(self, client, latency):
+        with self._lock:
+            stats = self._get(client)
+            # A failure is at least as slow as the time it took to fail
+            stats["latency"] = latency if stats["latency"] is None else (
+                    self._alpha * max(latency, stats["latency"]) + (1 - self._alpha) * stats["latency"])
+            stats["error_rate"] = self._alpha + (1 - self._alpha) * stats["error_rate"]
+            stats["consecutive_failures"] += 1
+
+            if stats["state"] == CircuitState.HALF_OPEN:
+                stats["state"] = CircuitState.OPEN
+                stats["opened_at"] = time.time()
+                stats["open_interval"] = min(2 * stats["open_interval"], self._max_open_interval)
+                logger.warning(f"Probe of {client} failed; circuit open for {stats['open_interval']}s")
+            elif stats["state"] == CircuitState.CLOSED and stats["consecutive_failures"] >= self._failure_threshold:
+                stats["state"] = CircuitState.OPEN
+                stats["opened_at"] = time.time()
+                logger.warning(f"{client} failed {stats['consecutive_failures']} times in a row; "
+                               f"circuit open for {stats['open_interval']}s")
+            stats["probe_in_flight"] = False
+            self._save()
+
+    def summary(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+from enum import Enum, IntEnum, auto
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class State(Enum):
+    STARTUP = auto()
+    LISTENING = auto()
+    LOADING = auto()
+    IMAGE = auto()
+
+
+class Priority(IntEnum):
+    PERIODIC = 0
+    ON_DEMAND = 1
+
+
+class DisplayClaim:
+    """A dream's right to the display. It is taken when the dream starts, but the display is only held while inside
+    `with claim:`. A claim of higher priority preempts all the claims of lower priority that are still open; a
+    preempted claim is never given the display."""
+
+    def __init__(self, scheduler, priority):
+        self._scheduler = scheduler
+        self.priority = priority
+        self.created = time.monotonic()
+        self.preempted = False
+
+    def __enter__(self):
+        """Waits for the display; returns False (and doesn't hold it) if the claim was preempted in the meantime"""
+        return self._scheduler._acquire(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._scheduler._release(self)
+
+    def close(self):
+        """The dream is over, shown or not"""
+        self._scheduler._close(self)
+
+
+class DreamScheduler:
+    """Owns the State machine and the display, and wakes up whoever waits on either as soon as something changes, rather
+    than having them poll. On-demand dreams preempt periodic ones (see DisplayClaim), and periodic dreams wait on a timer
+    for the display to have been left alone for a while (see `wait_until_due`).
+    """
+
+    # States in which somebody is talking to the device or waiting for their dream
+    busy_states = (State.LISTENING, State.LOADING)
+
+    def __init__(self, initial_image="assets/logo.jpeg"):
+        self._cond = threading.Condition()
+        self._state = State.STARTUP
+        self._state_since = time.monotonic()
+        self._last_image_ts = 0
+        self._last_image = initial_image
+        self._claims = list()  # Open claims
+        self._holder = None  # Claim holding the display
+        self._running = True
+
+    def set_state(self, state):
+        with self._cond:
+            now = time.monotonic()
+            metrics.observe("state", now - self._state_since, state=self._state.name)
+            metrics.increment("state_transitions", to=state.name)
+            self._state = state
+            self._state_since = now
+            self._cond.notify_all()
+        logger.info(f"State set to {state}")
+
+    def get_state(self):
+        with self._cond:
+            return self._state
+
+    def is_busy(self):
+        with self._cond:
+            return self._state in self.busy_states or any(claim.priority == Priority.ON_DEMAND
+                                                          for claim in self._claims)
+
+    def set_last_image(self, image, ts=None):
+        with self._cond:
+            self._last_image_ts = ts or time.time()
+            self._last_image = image
+            self._cond.notify_all()
+        logger.info(f"Last image was {image}\nDisplayed at {self._last_image_ts}")
+
+    def get_last_image(self):
+        with self._cond:
+            return self._last_image
+
+    def get_last_image_ts(self):
+        with self._cond:
+            return self._last_image_ts
+
+    def claim(self, priority):
+        """Opens a claim on the display for a new dream; see DisplayClaim"""
+        claim = DisplayClaim(self, priority)
+        with self._cond:
+            for other in self._claims:
+                if other.priority < priority and not other.preempted:
+                    other.preempted = True
+                    metrics.increment("preemptions", priority=other.priority.name)
+                    logger.info(f"{priority.name} dream preempts {other.priority.name} dream")
+            self._claims.append(claim)
+            self._cond.notify_all()
+        return claim
+
+    def _acquire(self, claim):
+        with self._cond:
+            self._cond.wait_for(lambda: claim.preempted or self._holder is None)
+            if claim.preempted:
+                return False
+            self._holder = claim
+            return True
+
+    def _release(self, claim):
+        with self._cond:
+            if self._holder is claim:
+                self._holder = None
+                self._cond.notify_all()
+
+    def _close(self, claim):
+        with self._cond:
+            if claim in self._claims:
+                self._claims.remove(claim)
+            if self._holder is claim:
+                self._holder = None
+            self._cond.notify_all()
+
+    def wait_until_due(self, period):
+        """Blocks until no on-demand dream is under way and nothing has been shown for `period` seconds.
+        Returns False if the scheduler was stopped instead."""
+        with self._cond:
+            while self._running:
+                if self._state in self.busy_states or any(claim.priority == Priority.ON_DEMAND
+                                                          for claim in self._claims):
+                    # Woken up by the state change or the closed claim
+                    timeout = None
+                else:
+                    timeout = self._last_image_ts + period - time.time()
+                    if timeout <= 0:
+                        return True
+                self._cond.wait(timeout)
+                metrics.increment("scheduler_wakeups")
+            return False
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            for claim in self._claims:
+                claim.preempted = True
+            self._cond.notify_all()
@@ -0,0 +1,119 @@
+import difflib
+import logging
+import threading
+import time
+
+from dream_cache import DreamCache
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DreamSpeculator:
+    """Starts generating a spoken dream before listening has ended, as soon as the interim transcript has stayed the
+    same for `stable_for` seconds; end-of-utterance detection alone takes about a second. If the final transcript is
+    close enough to the one the image was started for, that image is used. Otherwise it is cancelled, and counts
+    towards `max_wasted`.
+    """
+
+    def __init__(self, dreamer, stable_for=0.7, min_words=3, min_similarity=0.9, max_wasted=1):
+        """
+        stable_for: Seconds an interim transcript has to stay unchanged to be dreamt speculatively
+        min_words: Shorter transcripts are too likely to go on to be worth a speculation
+        min_similarity: How similar (0 to 1, see difflib.SequenceMatcher.ratio) the final transcript has to be to the
+            speculated one for its image to be used
+        max_wasted: Speculations per dream that may be thrown away; no more are started for a dream once that many
+            have been. 0 disables speculation. Cancelling aborts the requests, but some providers may still charge.
+        """
+        self._dreamer = dreamer
+        self._stable_for = stable_for
+        self._min_words = min_words
+        self._min_similarity = min_similarity
+        self._max_wasted = max_wasted
+        self._lock = threading.Lock()
+        self._timer = None
+        self._params = None
+        self._transcript = str()
+        self._speculation = None
+        self._wasted = 0
+        self._weight = 1.0
+
+    def begin(self, height=1024, width=1024, steps=4, weight=1.0):
+        """Starts listening to the transcripts of a new dream"""
+        with self._lock:
+            self._cancel_timer()
+            self._params = {"height": height, "width": width, "steps": steps}
+            self._weight = weight
+            self._transcript = str()
+            self._speculation = None
+            self._wasted = 0
+
+    def similarity(self, a, b):
+        return difflib.SequenceMatcher(None, DreamCache.normalize_prompt(a), DreamCache.normalize_prompt(b)).ratio()
+
+    def update(self, transcript):
+        """To be called with every interim transcript"""
+        with self._lock:
+            if self._params is None or transcript == self._transcript:
+                return
+            self._transcript = transcript
+            self._cancel_timer()
+            if self._speculation and self.similarity(transcript, self._speculation.text) < self._min_similarity:
+                self._waste(self._speculation, f"'{transcript}' has moved on from '{self._speculation.text}'")
+                self._speculation = None
+            if not self._speculation and self._wasted < self._max_wasted and \
+                    len(transcript.split()) >= self._min_words:
+                self._timer = threading.Timer(self._stable_for, self._on_stable, args=(transcript,))
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _on_stable(self, transcript):
+        with self._lock:
+            if self._params is None or transcript != self._transcript or self._speculation:
+                return
+            self._speculation = self._dreamer.speculate(transcript, **self._params)
+            if self._speculation:
+                metrics.increment("speculations_started")
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _waste(self, speculation, reason):
+        logger.info(f"Cancelling speculative dream: {reason}")
+        speculation.cancel()
+        self._wasted += 1
+        metrics.increment("speculations_wasted")
+
+    def finish(self, final_transcript):
+        """Returns the path of the speculated image if it matches `final_transcript`, or None if the dream has to be
+        visualized as usual"""
+        finished_at = time.monotonic()
+        with self._lock:
+            self._cancel_timer()
+            speculation, self._speculation = self._speculation, None
+            self._params = None
+            if not speculation:
+                return None
+            similarity = self.similarity(final_transcript, speculation.text)
+            if not final_transcript or similarity < self._min_similarity:
+                self._waste(speculation, f"final transcript '{final_transcript}' is too different ({similarity:.2f})")
+                return None
+
+        dream_img, latency = speculation.commit(weight=self._weight)
+        if not dream_img:
+            metrics.increment("speculations_failed")
+            return None
+
+        # Without speculation the image would have been ready `latency` seconds after listening ended
+        saved = min(latency, finished_at - speculation.started)
+        metrics.increment("speculations_committed")
+        metrics.observe("speculation_saved", saved)
+        logger.info(f"Speculative dream '{speculation.text}' used for '{final_transcript}' ({similarity:.2f}); "
+                    f"saved {saved:.2f}s")
+        return dream_img
+
+    def cancel(self):
+        """No dream after all"""
+        self.finish("")
@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SpeechBackend:
+    """Streaming speech-to-text engine. `transcribe` consumes LINEAR16 16kHz mono audio chunks and yields the full
+    transcript heard so far every time it changes, until the end of the utterance."""
+    name = None
+
+    def transcribe(self, audio_generator):
+        raise NotImplementedError
+
+    def warm_up(self):
+        """Loads whatever is loaded lazily, ahead of the first dream"""
+        pass
+
+    def __str__(self):
+        return self.name
+
+
+class GoogleSpeechBackend(SpeechBackend):
+    """Google Cloud Speech-to-Text"""
+    name = "google"
+
+    def __init__(self, credentials_path=".google-api-key.json", language_code="en-US", sample_rate=16000):
+        if not os.path.isfile(credentials_path):
+            raise FileNotFoundError(f"Google Cloud credentials {credentials_path} not found")
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = credentials_path
+        self._language_code = language_code
+        self._sample_rate = sample_rate
+        # google-cloud-speech takes long to import, so the client is only created when needed
+        self._speech = None
+        self._speech_client = None
+        self._streaming_config = None
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        with self._lock:
+            if self._speech_client is None:
+                self._create_client()
+
+    def _create_client(self):
+        from google.cloud import speech
+
+        config = speech.RecognitionConfig(
+            encoding=speech.RecognitionConfig.AudioEncoding.LINEAR16,
+            sample_rate_hertz=self._sample_rate,
+            language_code=self._language_code,
+        )
+
+        self._streaming_config = speech.StreamingRecognitionConfig(
+            config=config,
+            interim_results=True,
+            single_utterance=True
+        )
+        self._speech = speech
+        self._speech_client = speech.SpeechClient()
+
+    def transcribe(self, audio_generator):
+        self.warm_up()
+        speech = self._speech
+        requests = (
+            speech.StreamingRecognizeRequest(audio_content=content)
+            for content in audio_generator
+        )
+
+        responses = self._speech_client.streaming_recognize(self._streaming_config, requests)
+
+        finalized_transcript = str()
+
+        for response in responses:
+            logger.debug(f"Response from Google Cloud:\n{response}")
+            if not response.results:
+                if response.speech_event_type == speech.StreamingRecognizeResponse.SpeechEventType.END_OF_SINGLE_UTTERANCE:
+                    break
+                continue
+
+            if not response.results[0].alternatives:
+                continue
+
+            current_transcript = str()
+            # We take transcription of the top alternative from all the results as some chunks might never be deemed "is_final".
+            for result in response.results:
+                this_transcript = result.alternatives[0].transcript
+
+                if result.is_final:
+                    finalized_transcript += this_transcript
+                else:
+                    current_transcript += this_transcript
+
+            full_transcript = finalized_transcript + " " + current_transcript
+            yield full_transcript
+
+
+class VoskSpeechBackend(SpeechBackend):
+    """Offline recognition on the device's CPU with Vosk (https://alphacephei.com/vosk/models).
+    The small English model runs in real time on a Raspberry Pi 4."""
+    name = "vosk"
+
+    def __init__(self, model_path=os.path.join("models", "vosk-model-small-en-us-0.15"), sample_rate=16000,
+                 no_speech_timeout=5.0, max_duration=15.0):
+        """
+        no_speech_timeout: Seconds of audio after which listening stops if nothing has been recognized
+        max_duration: Seconds of audio after which listening stops regardless
+        """
+        import vosk
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        if not os.path.isdir(model_path):
+            raise FileNotFoundError(f"Vosk model {model_path} not found")
+        self._model_path = model_path
+        # Loading the model takes a while, so it's only done when needed
+        self._model = None
+        self._lock = threading.Lock()
+        self._sample_rate = sample_rate
+        self._no_speech_timeout = no_speech_timeout
+        self._max_duration = max_duration
+
+    def warm_up(self):
+        with self._lock:
+            if self._model is None:
+                self._model = self._vosk.Model(self._model_path)
+
+    def transcribe(self, audio_generator):
+        self.warm_up()
+        recognizer = self._vosk.KaldiRecognizer(self._model, self._sample_rate)
+        full_transcript = str()
+        audio_seconds = 0.0
+
+        for content in audio_generator:
+            audio_seconds += len(content) / (2 * self._sample_rate)
+
+            # Vosk reports a final result once it detects the end of the utterance
+            if recognizer.AcceptWaveform(content):
+                full_transcript = json.loads(recognizer.Result()).get("text", "")
+                if full_transcript:
+                    yield full_transcript
+                    return
+            else:
+                partial = json.loads(recognizer.PartialResult()).get("partial", "")
+                if partial and partial != full_transcript:
+                    full_transcript = partial
+                    yield full_transcript
+
+            if not full_transcript and audio_seconds > self._no_speech_timeout:
+                return
+
+            if audio_seconds > self._max_duration:
+                break
+
+        final = json.loads(recognizer.FinalResult()).get("text", "")
+        if final and final != full_transcript:
+            yield final
+
+
+_backends = {backend.name: backend for backend in (GoogleSpeechBackend, VoskSpeechBackend)}
+
+
+def create_speech_backend(name, **kwargs):
+    if name not in _backends:
+        raise ValueError(f"Unknown speech backend {name}; choose from {list(_backends)}")
+    return _backends[name](**kwargs)
+
+
+class TranscriptLatency:
+    """Times to the first (non-empty) and the last transcript of one utterance, from when listening started"""
+
+    def __init__(self):
+        self._t0 = time.monotonic()
+        self.first_word = None
+        self.final = None
+
+    def update(self, transcript):
+        elapsed = time.monotonic() - self._t0
+        if self.first_word is None and transcript.strip():
+            self.first_word = elapsed
+        self.final = elapsed
@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dream_archive import DreamArchive  # noqa: E402
+
+
+def add(archive, key, shown=True):
+    path = archive.path_for(key)
+    with open(path, "wb") as f:
+        f.write(b"\0" * 100)
+    archive.add(key, path, prompt=key, shown=shown)
+    return path
+
+
+def test_pinned_dreams_are_never_evicted(tmp_path):
+    archive = DreamArchive(str(tmp_path), max_count=2)
+    add(archive, "on_screen")
+    archive.pin("on_screen")
+    for key in ("a", "b", "c", "d"):
+        add(archive, key)
+
+    assert archive.contains("on_screen")
+    assert len(archive) == 2
+
+    archive.unpin("on_screen")
+    add(archive, "e")
+    assert not archive.contains("on_screen")
+
+
+def test_unshown_dreams_are_never_evicted_nor_sampled(tmp_path):
+    archive = DreamArchive(str(tmp_path), max_count=1)
+    prefetched = add(archive, "prefetched", shown=False)
+    for key in ("a", "b", "c"):
+        add(archive, key)
+
+    assert archive.contains("prefetched")
+    assert all(archive.sample() != prefetched for _ in range(50))
+
+    archive.mark_shown("prefetched")
+    assert archive.contains("prefetched")
+    assert len(archive) == 1
+
+
+def test_a_dream_shown_again_is_evicted_last(tmp_path):
+    archive = DreamArchive(str(tmp_path), max_count=2)
+    add(archive, "old")
+    # Apart enough to be ordered by the clock
+    time.sleep(0.01)
+    add(archive, "newer")
+    time.sleep(0.01)
+    archive.mark_shown("old")
+    add(archive, "newest")
+
+    assert archive.contains("old")
+    assert not archive.contains("newer")
@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeInferenceClient  # noqa: E402
+from dreamer import Dreamer  # noqa: E402
+from inference_clients import AsyncHFInferenceClient, AsyncNebiusClient  # noqa: E402
+
+# The cost cap of main.create_dreamer, at the size of the dreams on the device's 16:9 screen
+MAX_REQUEST_COST = 0.0015
+HEDGE_DELAY = 0.2
+WIDTH, HEIGHT = 1808, 1024
+
+
+def race(tmp_path, backup_cost):
+    slow = FakeInferenceClient("slow", median_latency=3, sigma=0.01, seed=0)
+    backup = FakeInferenceClient("backup", median_latency=0.2, sigma=0.01, cost_per_image=backup_cost, seed=1)
+    dreamer = Dreamer(clients=[slow, backup], hedge_delay=HEDGE_DELAY, max_request_cost=MAX_REQUEST_COST,
+                      dreams_dir=str(tmp_path))
+    # The slow client is tried first whatever its stats say
+    dreamer._provider_stats.ranked = lambda clients: [slow, backup]
+    try:
+        t0 = time.monotonic()
+        image, client, _ = dreamer._start_generation("a cat", HEIGHT, WIDTH, 4).result(timeout=30)
+        return client, time.monotonic() - t0
+    finally:
+        dreamer.shutdown()
+
+
+def test_hedge_fires_at_the_app_image_size(tmp_path):
+    client, seconds = race(tmp_path, AsyncNebiusClient.cost_per_image)
+
+    assert str(client) == "backup"
+    assert seconds < 2
+
+
+def test_hedge_stays_within_the_cost_cap(tmp_path):
+    client, _ = race(tmp_path, AsyncHFInferenceClient.cost_per_image)
+
+    assert str(client) == "slow"
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from listener import Endpointer  # noqa: E402
+
+SAMPLE_RATE = 16000
+CHUNK = 1600  # 100ms, as the microphone stream delivers it
+
+
+def chunks(*parts):
+    """Splits (seconds, amplitude) parts of a noise signal into LINEAR16 chunks"""
+    rng = np.random.default_rng(0)
+    pcm = np.concatenate([rng.normal(0, amplitude, round(seconds * SAMPLE_RATE)) for seconds, amplitude in parts])
+    pcm = np.clip(pcm, -32768, 32767).astype(np.int16)
+    return [pcm[i:i + CHUNK].tobytes() for i in range(0, len(pcm), CHUNK)]
+
+
+def test_click_then_silence_ends_the_stream():
+    audio = chunks((0.5, 30), (0.04, 8000), (60, 30))
+    endpointer = Endpointer(SAMPLE_RATE, no_speech_timeout=5.0)
+    sent = b"".join(endpointer.filter(iter(audio)))
+
+    assert endpointer.ended
+    assert endpointer.stats()["heard"] < 6
+    # The silence after the click was not sent beyond the trailing pad
+    assert len(sent) / 2 / SAMPLE_RATE < 1
+
+
+def test_speech_then_silence_ends_after_the_hangover():
+    endpointer = Endpointer(SAMPLE_RATE, hangover=0.6)
+    list(endpointer.filter(iter(chunks((0.5, 30), (1.0, 8000), (10, 30)))))
+
+    assert endpointer.ended
+    assert endpointer.stats()["since_speech"] < 1
+
+
+def test_resumed_speech_is_sent_with_at_most_the_trailing_pad_before_it():
+    endpointer = Endpointer(SAMPLE_RATE, hangover=2.0, trailing_pad=0.2)
+    sent = b"".join(endpointer.filter(iter(chunks((1.0, 8000), (1.5, 30), (1.0, 8000), (5, 30)))))
+
+    assert endpointer.ended
+    # Both stretches of speech, plus at most a trailing pad on either side of the pause and one at the end
+    assert len(sent) / 2 / SAMPLE_RATE <= 2.0 + 3 * 0.2 + 0.05
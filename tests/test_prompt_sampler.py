@@ -0,0 +1,46 @@
+import itertools
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_sampler import PromptSampler  # noqa: E402
+
+PROMPT_LISTS = {
+    "subjects": ["a cat", "a dog", "an owl", "a fox", "a whale"],
+    "actions": ["cooking", "dancing", "sleeping"],
+    "places": ["in a garden", "on the moon", "under the sea", "in a library"],
+}
+TEMPLATE = "{subjects} {actions} {places}"
+SIZE = 5 * 3 * 4
+
+
+def sampler(tmp_path):
+    return PromptSampler(PROMPT_LISTS, template=TEMPLATE, state_path=str(tmp_path / ".prompt_sampler.json"))
+
+
+def test_no_prompt_repeats_until_all_of_them_are_used(tmp_path):
+    prompt_sampler = sampler(tmp_path)
+    prompts = [prompt_sampler.sample() for _ in range(SIZE)]
+
+    assert len(set(prompts)) == SIZE
+    assert set(prompts) == {" ".join(combination) for combination in itertools.product(*PROMPT_LISTS.values())}
+    # The next walk starts over, through all of them again
+    assert len({prompt_sampler.sample() for _ in range(SIZE)}) == SIZE
+
+
+def test_resumes_where_it_left_off_after_a_restart(tmp_path):
+    prompt_sampler = sampler(tmp_path)
+    before = [prompt_sampler.sample() for _ in range(SIZE // 2)]
+    restarted = sampler(tmp_path)
+    after = [restarted.sample() for _ in range(SIZE - SIZE // 2)]
+
+    assert len(set(before + after)) == SIZE
+
+
+def test_starts_a_new_walk_when_the_prompt_lists_change(tmp_path):
+    sampler(tmp_path).sample()
+    changed = PromptSampler(dict(PROMPT_LISTS, subjects=PROMPT_LISTS["subjects"] + ["a bee"]), template=TEMPLATE,
+                            state_path=str(tmp_path / ".prompt_sampler.json"))
+
+    assert len({changed.sample() for _ in range(SIZE + 3 * 4)}) == SIZE + 3 * 4
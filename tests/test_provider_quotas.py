@@ -0,0 +1,70 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeInferenceClient  # noqa: E402
+from dreamer import Dreamer  # noqa: E402
+from provider_quotas import ProviderQuotas  # noqa: E402
+
+
+class PaidClient:
+    cost_per_image = 0.01
+    monthly_budget = 0.05
+    requests_per_minute = None
+
+    def __str__(self):
+        return "paid"
+
+
+def test_concurrent_reservations_stay_within_the_budget(tmp_path):
+    quotas = ProviderQuotas(state_path=str(tmp_path / ".provider_quotas.json"))
+    client = PaidClient()
+    start = threading.Barrier(20)
+
+    def acquire():
+        start.wait()
+        return quotas.acquire(client)
+
+    with ThreadPoolExecutor(20) as executor:
+        acquired = list(executor.map(lambda _: acquire(), range(20)))
+
+    assert acquired.count(True) == 5
+    assert not quotas.has_capacity(client)
+
+
+def test_refunded_reservations_can_be_used_again(tmp_path):
+    quotas = ProviderQuotas(state_path=str(tmp_path / ".provider_quotas.json"))
+    client = PaidClient()
+    while quotas.acquire(client):
+        pass
+    quotas.refund(client)
+    quotas.record_success(client)
+
+    assert quotas.acquire(client)
+    assert quotas.summary()["paid"]["spent"] <= client.monthly_budget
+
+
+def test_reservations_scale_with_the_image_size(tmp_path):
+    quotas = ProviderQuotas(state_path=str(tmp_path / ".provider_quotas.json"))
+    client = PaidClient()
+
+    # A quarter of the pixels of 1024x1024, so four times as many images
+    assert sum(quotas.acquire(client, 512, 512) for _ in range(30)) == 20
+
+
+def test_concurrent_dreams_never_overspend(tmp_path):
+    client = FakeInferenceClient("paid", median_latency=0.3, sigma=0.1, cost_per_image=0.01, seed=0)
+    dreamer = Dreamer(clients=[client], dreams_dir=str(tmp_path), quota_limits={"paid": {"monthly_budget": 0.05}})
+    try:
+        with ThreadPoolExecutor(12) as executor:
+            dreams = list(executor.map(lambda i: dreamer.visualize(f"dream {i}"), range(12)))
+    finally:
+        dreamer.shutdown()
+
+    quota = dreamer.get_provider_quotas()["paid"]
+    assert quota["images"] == 5
+    assert quota["spent"] <= 0.05 + 1e-9
+    assert sum(bool(dream) for dream in dreams) == 5